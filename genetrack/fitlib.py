@@ -4,40 +4,177 @@ Data fitting and peak prediction routines
 import genetrack
 from genetrack import logger, conf
 from itertools import *
-import numpy, operator
+import numpy, operator, threading
 from math import log, exp
 
-def normal_function( w, sigma ):
+# kernels longer than this are convolved via the fast fourier transform
+FFT_LIMIT = 400
+
+# the convolutions are rounded to this many bits below their largest value
+SNAP_BITS = 36
+
+# the number of kernels kept in the cache
+KERNEL_CACHE_SIZE = 64
+
+def gaussian_kernel( u ):
+    "Normal curve, not normalized thus will correspond to read counts"
+    return numpy.exp( -u * u / 2 )
+
+def triangle_kernel( u ):
+    "Triangle with the variance of the normal curve"
+    return numpy.maximum( 1 - abs(u) / numpy.sqrt(6), 0 )
+
+def epanechnikov_kernel( u ):
+    "Parabola with the variance of the normal curve"
+    return numpy.maximum( 1 - u * u / 5, 0 )
+
+def uniform_kernel( u ):
+    "Constant with the variance of the normal curve"
+    return numpy.where( abs(u) <= numpy.sqrt(3), 1.0, 0.0 )
+
+# the kernels keyed by their codes, each takes the distances measured in sigmas,
+# the second element is the support of the kernel measured in sigmas
+KERNELS = {
+    'GK': ( gaussian_kernel, 5 ),
+    'TK': ( triangle_kernel, numpy.sqrt(6) ),
+    'EK': ( epanechnikov_kernel, numpy.sqrt(5) ),
+    'UK': ( uniform_kernel, numpy.sqrt(3) ),
+}
+
+# the choices that may be offered in the interface
+KERNEL_CHOICES = [ 
+    ('GK', 'Gaussian kernel'), ('TK', 'Triangle kernel'), 
+    ('EK', 'Epanechnikov kernel'), ('UK', 'Uniform kernel'),
+]
+
+# the names of the kernels in the method option of the peakpred script
+KERNEL_METHODS = { 'GK': 'gauss', 'TK': 'triangle', 'EK': 'epanechnikov', 'UK': 'uniform' }
+
+class KernelCache(object):
+    """
+    A bounded cache of kernel values, the least recently used 
+    kernels are dropped when the cache is full.
+    """
+    def __init__(self, size=KERNEL_CACHE_SIZE):
+        self.size  = size
+        self.lock  = threading.Lock()
+        self.store = {}
+        self.order = []
+
+    def get(self, key, func):
+        "Returns the value for a key, calls func to create it when missing"
+        self.lock.acquire()
+        try:
+            if key in self.store:
+                self.order.remove( key )
+            else:
+                if len(self.order) >= self.size:
+                    del self.store[ self.order.pop(0) ]
+                self.store[key] = func()
+            self.order.append( key )
+            return self.store[key]
+        finally:
+            self.lock.release()
+
+CACHE = KernelCache()
+
+def kernel_function( w, sigma, kernel='GK', dtype=numpy.float ):
+    """
+    Returns the values of a kernel over a certain width. The values
+    are cached and are read only.
+
+    >>> lo, hi, values = kernel_function( w=2, sigma=1, kernel='TK' )
+    >>> lo, hi, list( values.round(2) )
+    (2, 3, [0.18, 0.59, 1.0, 0.59, 0.18])
+    >>> values is kernel_function( w=2, sigma=1, kernel='TK' )[2]
+    True
+    >>> values.flags.writeable
+    False
+    """
+    lo, hi  = int(-w), int(w+1)
+    func = KERNELS[kernel][0]
+
+    def compute():
+        values = func( numpy.arange(lo, hi) / float(sigma) ).astype( dtype )
+        values.flags.writeable = False
+        return values
+
+    key = ( kernel, lo, hi, float(sigma), numpy.dtype(dtype).str )
+    return abs(lo), hi, CACHE.get( key, compute )
+
+def normal_function( w, sigma, dtype=numpy.float ):
     """
     Defaulf fitting function, it returns values 
     from a normal distribution over a certain width.
 
     The function is not normalized thus will be a representation of the sum of readcounts.
     """
-    log2    = log(2)
-    sigma2  = float(sigma)**2
-    lo, hi  = int(-w), int(w+1)
-    pi = numpy.pi
+    return kernel_function( w=w, sigma=sigma, kernel='GK', dtype=dtype )
 
-    # function definition, not normalized
-    # thus will correspond to read counts
-    def normal_func(index):
-        return exp( -index*index/sigma2/2 )    
-    
-    values = map( normal_func, range(lo, hi) )
-    values = numpy.array( values, numpy.float )
+def snap( values, bits=SNAP_BITS ):
+    """
+    Rounds the values to a power of two fraction of the largest one,
+    this removes the rounding noise that depends on the summation order.
 
-    return abs(lo), hi, values
+    >>> list( snap( numpy.array( [ 4.0, 1.0 + 1e-14, 1e-17 ] ) ) )
+    [4.0, 1.0, 0.0]
+    """
+    top = len(values) and abs(values).max()
+    if not top:
+        return values
+    quantum = 2.0 ** ( numpy.frexp(top)[1] - bits )
+    return numpy.round( values / quantum ) * quantum
+
+def convolve( data, kernel ):
+    """
+    Returns the full discrete convolution of the data with a kernel. 
+    Short kernels are convolved directly, the kernels longer than FFT_LIMIT 
+    via the fast fourier transform. The results of both are snapped 
+    (see `snap`) so that equal sums stay equal whichever path is taken.
+
+    >>> data, kernel = [ 1.0, 0.0, 2.0 ], [ 1.0, 0.5 ]
+    >>> list( convolve( data, kernel ) )
+    [1.0, 0.5, 2.0, 1.0]
+    >>> kernel = numpy.ones( FFT_LIMIT + 1 )
+    >>> result = convolve( data, kernel )
+    >>> len(result), list( result[:3].round(6) ), list( result[-3:].round(6) )
+    (403, [1.0, 1.0, 3.0], [3.0, 2.0, 2.0])
+    """
+    if len(kernel) <= FFT_LIMIT:
+        return snap( numpy.convolve( data, kernel ) )
+    
+    # the transforms are padded to a power of two
+    size = len(data) + len(kernel) - 1
+    fsize = 2 ** int( numpy.ceil( numpy.log2(size) ) )
+    result = numpy.fft.irfft( numpy.fft.rfft(data, fsize) * numpy.fft.rfft(kernel, fsize), fsize )[:size]
+    return snap( result )
 
-def gaussian_smoothing(x, y, sigma=20, epsilon=0.1 ):
+def gaussian_smoothing(x, y, sigma=20, epsilon=0.1, kernel='GK', dtype=numpy.float ):
     """
     Fits data represented by f(x)=y by a sum of normal curves where
     each curve corresponds to a normal function of variance=sigma and
-    height equal to the y coordinate.
-
-    Parameters x and y are lists.
-
-    Returns a tuple of with the new x, and y coordinates.
+    height equal to the y coordinate. Other kernels from KERNELS 
+    with the same variance may be selected by their codes. The dtype 
+    sets the precision of the returned values, the convolution itself 
+    runs in double precision as that is the faster one in numpy.
+
+    Parameters x and y are lists, x must be sorted.
+
+    Returns a tuple of with the new x, and y coordinates, 
+    only values above epsilon are kept.
+
+    >>> x, y = [ 100, 10**7 ], [ 1.0, 2.0 ]
+    >>> fx, fy = gaussian_smoothing( x, y, sigma=1, epsilon=0.5 )
+    >>> list(fx)
+    [99, 100, 101, 9999999, 10000000, 10000001]
+    >>> list(fy.round(2))
+    [0.61, 1.0, 0.61, 1.21, 2.0, 1.21]
+    >>> fx, fy = gaussian_smoothing( x, y, sigma=1, epsilon=0.5, kernel='UK' )
+    >>> list(fx), list(fy)
+    ([99, 100, 101, 9999999, 10000000, 10000001], [1.0, 1.0, 1.0, 2.0, 2.0, 2.0])
+    >>> fx, fy = gaussian_smoothing( x, y, sigma=1, epsilon=0.5, dtype=numpy.float32 )
+    >>> fy.dtype, list(fy.round(2))
+    (dtype('float32'), [0.61, 1.0, 0.61, 1.21, 2.0, 1.21])
     """
     if len(x)==0:
         return x, y
@@ -52,44 +189,96 @@ def gaussian_smoothing(x, y, sigma=20, epsilon=0.1 ):
     # a sanity check
     assert len(x)==len(y), "Data lenghts must match!"
 
-    # operate within 5 standard deviations
-    w = 5 * sigma 
+    # operate within the support of the kernel, 5 standard deviations for the normal
+    w = KERNELS[kernel][1] * sigma 
 
     # precompute the fitting values for a given sigma,
-    lo, hi, normal = normal_function( w=w, sigma=sigma )
-
-    # shift the original vector by the first index, so that 
-    # the first index starts at the value lo
-    # this copies the array
-    zero_x = x - x[0] + lo
-
-    # the size will influence memory consumption
-    # long vectors need to be stiched together externally
-    # uses around 100MB per 10 million size
-    # on live displays there is no need to fit over large regions (over 100K)
-    # as the features won't be visible by eye 
-    size  = zero_x[-1] + lo + hi
-
-    # this will hold the new fitted values
-    new_y = numpy.zeros( size, numpy.float )
-
-    # performs the smoothing by mutating the array values in place
-    for index, value in izip(zero_x, y):
-        lox = index - lo
-        hix = index + hi
-        # this is where the magic happens
-        new_y[ lox:hix ] += value * normal
+    lo, hi, normal = kernel_function( w=w, sigma=sigma, kernel=kernel )
+
+    # islands of data separated by gaps wider than the support of the kernel
+    # do not influence each other, these gaps are shrunk to 2w+1 so that 
+    # the memory scales with the covered regions and not with the span
+    excess = numpy.maximum( numpy.diff(x) - (2 * w + 1), 0 )
+    shift  = numpy.zeros( len(x), numpy.int )
+    shift[1:] = excess.cumsum()
+    near_x = x - shift
+
+    # the values are scattered into a dense vector that starts at the first index
+    # uses around 100MB per 10 million covered bases
+    dense = numpy.bincount( near_x - near_x[0], weights=y )
+
+    # a single convolution adds the normal curve of each value,
+    # the result starts lo positions before the first index
+    new_y = convolve( dense, normal )
     
     # keep only values above the epsilon
     # this cuts out (potentially massive) regions where there are no measurements
     new_x = ( new_y > epsilon ).nonzero()[0] 
-    new_y = new_y.take(new_x)
+    new_y = numpy.asarray( new_y.take(new_x), dtype )
 
-    # now shift back to get the real indices
-    new_x =  new_x + x[0] - lo
+    # now shift back to get the real indices, each value 
+    # belongs to the island of the last index before value + w
+    new_x = new_x + near_x[0] - lo
+    owner = near_x.searchsorted( new_x + w, side='right' ) - 1
+    new_x = new_x + shift.take( owner )
 
     return new_x, new_y
 
+def smoothed_segments( chunks, sigma, epsilon, kernel='GK' ):
+    """
+    Smooths a stream of (x, y) chunks sorted by x. Yields the smoothed (fx, fy)
+    values in consecutive segments that are identical to smoothing 
+    all the data at once. The measurements within the support of the kernel 
+    are carried over into the next chunk.
+
+    >>> x, y = numpy.arange(0, 1000, 7), numpy.ones(143)
+    >>> chunks = [ (x[:50], y[:50]), (x[50:100], y[50:100]), (x[100:], y[100:]) ]
+    >>> segments = list( smoothed_segments( chunks, sigma=10, epsilon=0.1 ) )
+    >>> fx, fy = gaussian_smoothing( x, y, sigma=10, epsilon=0.1 )
+    >>> list( numpy.concatenate( [ sx for sx, sy in segments ] ) ) == list( fx )
+    True
+    >>> numpy.allclose( numpy.concatenate( [ sy for sx, sy in segments ] ), fy )
+    True
+    """
+    # the kernel reaches at most this far
+    margin = int( KERNELS[kernel][1] * sigma ) + 1
+    
+    carry_x, carry_y = numpy.zeros(0, numpy.int), numpy.zeros(0)
+    lo = None
+    for chunk in chain( chunks, [ None ] ):
+        
+        # the last step smooths the data that was carried over
+        last = chunk is None
+        if not last:
+            x = numpy.concatenate( (carry_x, chunk[0]) )
+            y = numpy.concatenate( (carry_y, chunk[1]) )
+        else:
+            x, y = carry_x, carry_y
+
+        if not len(x):
+            continue
+
+        fx, fy = gaussian_smoothing( x=x, y=y, sigma=sigma, epsilon=epsilon, kernel=kernel )
+
+        # the values below hi are not affected by the upcoming measurements
+        if last:
+            hi = fx[-1] + 1 if len(fx) else 0
+        else:
+            hi = x[-1] - margin + 1
+        if lo is not None:
+            hi = max( lo, hi )
+        
+        if lo is None:
+            keep = fx < hi
+        else:
+            keep = (fx >= lo) & (fx < hi)
+        yield fx[keep], fy[keep]
+        
+        # carry over the measurements that influence values above hi
+        lo = hi
+        keep = x >= lo - margin
+        carry_x, carry_y = x[keep], y[keep]
+
 def detect_peaks( x, y ):
     """
     Detects peaks (local maxima) from an iterators x and y 
@@ -108,13 +297,13 @@ def detect_peaks( x, y ):
     >>> select_peaks( peaks, exclusion=2)
     [(4, 3.5), (8, 10.5)]
     """
-    peaks = []
-    # finds local maxima 
-    for i in xrange(1, len(y)-1 ):
-        left, mid, right = y[i-1], y[i], y[i+1]
-        if left < mid >= right:
-            peaks.append( (x[i], mid) )
-    return peaks
+    x, y = numpy.asarray(x), numpy.asarray(y)
+
+    # finds local maxima by comparing to the shifted values
+    left, mid, right = y[:-2], y[1:-1], y[2:]
+    index = ( (left < mid) & (mid >= right) ).nonzero()[0] + 1
+    
+    return zip( x.take(index).tolist(), y.take(index).tolist() )
 
 def select_peaks( peaks, exclusion, threshold=0):
     """
@@ -134,53 +323,32 @@ def select_peaks( peaks, exclusion, threshold=0):
     if exclusion == 0:
         return peaks
 
-    # sort by peak height
-    work  = [ (y, x) for x, y in peaks if y >= threshold ]
-    work.sort()
-    work.reverse()
-
-    # none of the values passed the treshold
-    if not work:
-        return []
-
-    # this will store the selected peaks
-    selected = []
-
     # we assume that peaks are sorted already increasing order by x
-    xmin, xmax = peaks[0][0], peaks[-1][0]
-    
-    # we create an occupancy vector to keep track of empty regions 
-    size  = xmax - xmin + exclusion
-    shift = xmin - exclusion
+    xs = numpy.array( [ x for x, y in peaks ] )
+    ys = numpy.array( [ y for x, y in peaks ] )
 
-    # exclusion will be applied for both ends
-    # the size must fit into memory, int8 is fairly small though
-    # chop large chromosomes into chunks and predict on each
-    empty = numpy.ones(size + exclusion, numpy.int8)
+    # each peak blocks the peaks within [x - exclusion, x + exclusion)
+    lefts  = xs.searchsorted( xs - exclusion, side='left' )
+    rights = xs.searchsorted( xs + exclusion, side='left' )
+    
+    # sort by peak height, the largest first
+    order = numpy.lexsort( (xs, ys) )[::-1]
+    order = order[ ys.take(order) >= threshold ]
 
     # starting with the largest select from the existing peaks
-    for peaky, peakx in work:
-
-        # get the peak index as occupancy vector index
-        locind = peakx - shift
-        
-        # check region
-        if empty[locind]:
-            
-            # store this peak
-            selected.append( ( peakx, peaky ) )
-
-           # block the region
-            left  = locind - exclusion
-            right = locind + exclusion
-            empty[left:right] = numpy.zeros (right - left, numpy.int8)
+    blocked  = numpy.zeros( len(xs), numpy.bool )
+    selected = numpy.zeros( len(xs), numpy.bool )
+    for i in order.tolist():
+        if not blocked[i]:
+            selected[i] = True
+            blocked[ lefts[i]:rights[i] ] = True
     
-    selected.sort()
-    return selected
+    index = selected.nonzero()[0]
+    return zip( xs.take(index).tolist(), ys.take(index).tolist() )
 
-def fixed_width_predictor(x, y, params):   
+def fixed_width_predictor(x, y, params, step=1):   
     """
-    Generates peaks from a x,y dataset.
+    Generates peaks from a x,y dataset. The step of the coordinates is not used.
 
     >>> from genetrack import util
     >>>
@@ -211,6 +379,123 @@ def fixed_width_predictor(x, y, params):
 
     return results
 
+def label_peaks(starts, ends, values, params):
+    "Returns the (start, end, label) tuples, the labels are left out on large zoom levels"
+    starts, ends, values = map( list, (starts, ends, values) )
+    if int(params.zoom_value)> 5000:
+        labels = [ '' ] * len(values)
+    else:
+        labels = [ '%.1f' % v for v in values ]
+    return zip( starts, ends, labels )
+
+def threshold_predictor(x, y, params, step=1):
+    """
+    Generates the regions where the values are over the minimum peak. The 
+    regions are broken at the gaps of the x coordinates, the label is the maximal value.
+    The coordinates of the data are step apart, the stored smoothed tables may skip positions.
+
+    >>> from genetrack import util
+    >>>
+    >>> y = [ 0.0, 1.0, 2.5, 1.0, 3.5, 1.0, 0.0, 0.0, 10.5, 2.0, 1.0, 0.0 ]
+    >>> x = range(len(y))
+    >>>
+    >>> params = util.Params(minimum_peak=1, zoom_value=1)
+    >>> threshold_predictor(x, y, params=params)
+    [(1, 5, '3.5'), (8, 10, '10.5')]
+    >>> threshold_predictor(x[:4] + x[5:], y[:4] + y[5:], params=params)
+    [(1, 3, '2.5'), (5, 5, '1.0'), (8, 10, '10.5')]
+    >>> threshold_predictor(x[::2], y[::2], params=params, step=2)
+    [(2, 4, '3.5'), (8, 10, '10.5')]
+    """
+    x, y = numpy.asarray(x), numpy.asarray(y)
+    
+    index = ( y >= params.minimum_peak ).nonzero()[0]
+    if not len(index):
+        return []
+    
+    # a region ends where the selected values or the coordinates are not consecutive
+    ends   = ( (numpy.diff(index) != 1) | (numpy.diff(x.take(index)) != step) ).nonzero()[0]
+    starts = numpy.concatenate( ( [0], ends + 1 ) )
+    ends   = numpy.concatenate( ( ends, [ len(index) - 1 ] ) )
+    values = numpy.maximum.reduceat( y.take(index), starts )
+
+    return label_peaks( x.take(index.take(starts)), x.take(index.take(ends)), values, params)
+
+def all_maxima_predictor(x, y, params, step=1):
+    """
+    Generates fixed width features for all the local maxima over the minimum 
+    peak, these features may overlap. The step of the coordinates is not used.
+
+    >>> from genetrack import util
+    >>>
+    >>> y = [ 0.0, 1.0, 2.5, 1.0, 3.5, 1.0, 0.0, 0.0, 10.5, 2.0, 1.0, 0.0 ]
+    >>> x = range(len(y))
+    >>>
+    >>> params = util.Params(feature_width=4, minimum_peak=3, zoom_value=1)
+    >>> all_maxima_predictor(x, y, params=params)
+    [(2, 6, '3.5'), (6, 10, '10.5')]
+    """
+    h = params.feature_width/2
+    peaks = [ (m, v) for m, v in detect_peaks(x=x, y=y) if v >= params.minimum_peak ]
+    mids, values = numpy.array( [ m for m, v in peaks ], numpy.int ), [ v for m, v in peaks ]
+    return label_peaks( mids - h, mids + h, values, params )
+
+def adaptive_width_predictor(x, y, params, step=1):
+    """
+    Generates non-overlapping features where the width of each feature spans 
+    the region where the values are above half of the peak value. The 
+    region stops at the minima next to the peak and at the gaps of the x coordinates,
+    these are step apart.
+
+    >>> from genetrack import util
+    >>>
+    >>> y = [ 0.0, 1.0, 2.5, 1.0, 3.5, 1.0, 0.0, 0.0, 10.5, 6.0, 1.0, 0.0 ]
+    >>> x = range(len(y))
+    >>>
+    >>> params = util.Params(feature_width=1, minimum_peak=0, zoom_value=1)
+    >>> adaptive_width_predictor(x, y, params=params)
+    [(2, 2, '2.5'), (4, 4, '3.5'), (8, 9, '10.5')]
+    >>> params = util.Params(feature_width=1, minimum_peak=3, zoom_value=1)
+    >>> adaptive_width_predictor(x[:9] + x[10:], y[:9] + y[10:], params=params)
+    [(4, 4, '3.5'), (8, 8, '10.5')]
+    >>> adaptive_width_predictor(x[::2], y[::2], params=params, step=2)
+    [(2, 4, '3.5'), (8, 8, '10.5')]
+    """
+    x, y = numpy.asarray(x), numpy.asarray(y)
+    
+    sel_peaks = select_peaks( peaks=detect_peaks(x=x, y=y), exclusion=params.feature_width, threshold=params.minimum_peak )
+    if not sel_peaks:
+        return []
+    
+    mids   = numpy.array( [ m for m, v in sel_peaks ], numpy.int )
+    values = numpy.array( [ v for m, v in sel_peaks ] )
+    peaks  = x.searchsorted( mids )
+    
+    # the curve is monotonous between a peak and the neighbouring minima or gaps
+    left, mid, right = y[:-2], y[1:-1], y[2:]
+    minima = ( (left > mid) & (mid <= right) ).nonzero()[0] + 1
+    gaps   = ( numpy.diff(x) != step ).nonzero()[0]
+    lows   = numpy.union1d( minima, gaps + 1 )
+    highs  = numpy.union1d( minima, gaps )
+    lows   = numpy.concatenate( ( [0], lows ) ).take( lows.searchsorted( peaks, side='right' ) )
+    highs  = numpy.concatenate( ( highs, [ len(y) - 1 ] ) ).take( highs.searchsorted( peaks, side='left' ) )
+
+    # finds where the rising and falling sides cross half of the peak value
+    starts, ends = [], []
+    for peak, lo, hi, value in zip( peaks, lows, highs, values / 2 ):
+        starts.append( lo + y[lo:peak + 1].searchsorted( value ) )
+        ends.append( hi - y[peak:hi + 1][::-1].searchsorted( value ) )
+    
+    return label_peaks( x.take(starts), x.take(ends), values, params )
+
+# the peak predictors keyed by their codes
+PREDICTORS = {
+    'FIX': fixed_width_predictor,
+    'TRS': threshold_predictor,
+    'ALL': all_maxima_predictor,
+    'ADP': adaptive_width_predictor,
+}
+
 def test(verbose=0):
     """
     Main testrunnner
@@ -0,0 +1,259 @@
+"""
+Flat binary storage for positional data.
+
+Each column of each table is stored as a raw little-endian array file,
+a small JSON header lists the tables, their columns and row counts. The
+arrays are accessed via memory maps thus the queries are slices served from
+the operating system's page cache that may be shared by several processes.
+
+"""
+import os, threading
+import numpy
+from genetrack import logger, util, conf, hdflib
+
+try:
+    import json
+except ImportError:
+    # python 2.5
+    import simplejson as json
+
+# the name of the header file within the flat index directory
+HEADER = 'header.json'
+
+def flat_path( index ):
+    """
+    Returns the default path of the flat index converted from an HDF index,
+    the index pool prefers this over the HDF index (see `hdflib.IndexPool`)
+
+    >>> flat_path( 'data/reads.txt.hdf' )
+    'data/reads.txt.hdf.flat'
+    """
+    return '%s.flat' % index
+
+def is_current( index ):
+    """
+    True when the flat index of an HDF index exists 
+    and was written after the HDF index
+    """
+    header = os.path.join( flat_path(index), HEADER )
+    if not os.path.isfile( header ):
+        return False
+    return not os.path.isfile( index ) or os.path.getmtime( header ) >= os.path.getmtime( index )
+
+class FlatTable(object):
+    """
+    A table stored as one memory mapped array per column. Mimics the
+    parts of the pytables Table interface that the PositionalData uses.
+    """
+    def __init__(self, path, name, rows, columns, attrs={}):
+        self._v_pathname = name
+        self.nrows = rows
+        self.colnames = []
+        self.cols = util.Params()
+        self.attrs = util.Params( **dict( [ (str(key), value) for key, value in attrs.items() ] ) )
+        for colname, dtype in columns:
+            # the header strings are unicode
+            colname, dtype = str(colname), str(dtype)
+            self.colnames.append( colname )
+            fname = os.path.join( path, colname )
+            if rows:
+                values = numpy.memmap( fname, dtype=numpy.dtype(dtype), mode='r', shape=(rows,) )
+            else:
+                values = numpy.zeros( 0, dtype=numpy.dtype(dtype) )
+            setattr( self.cols, colname, values )
+
+    def __len__(self):
+        return self.nrows
+
+    def col(self, name):
+        "Returns a copy of a column"
+        return numpy.array( getattr(self.cols, name) )
+
+    def read(self, start=None, stop=None, step=None, field=None):
+        """
+        Returns the values of a field from start to stop, or a dictionary keyed
+        by column names for all fields. The values are views into the memory maps.
+        """
+        if field:
+            return getattr( self.cols, field )[start:stop:step]
+        return dict( [ (name, getattr(self.cols, name)[start:stop:step]) for name in self.colnames ] )
+
+class FlatData(hdflib.PositionalData):
+    """
+    A read only PositionalData stored in the flat binary format.
+    Create it from an HDF index with the `convert` function.
+
+    >>> from genetrack import conf
+    >>> fname = conf.testdata('test-hdflib-input.txt')
+    >>> index = hdflib.PositionalData(fname=fname, workdir=conf.TEMP_DATA_DIR)
+    >>> path  = convert( index.index, conf.tempdata('test-hdflib-input.flat') )
+    >>> flat  = FlatData( path )
+    >>> flat.labels
+    ['chr1', 'chr2', 'chr3']
+    >>> flat.indices('chr1', 400, 600)
+    (20, 31)
+    >>> results = flat.query( 'chr1', 400, 600)
+    >>> list(results.idx)
+    [402, 403, 411, 419, 427, 432, 434, 443, 587, 593, 596]
+    >>> list(results.val)
+    [3.0, 1.0, 1.0, 1.0, 1.0, 2.0, 1.0, 1.0, 1.0, 1.0, 1.0]
+    >>> results = flat.query( 'chr1', 0, 100000, pixels=100)
+    >>> list(results.val[:3])
+    [4.0, 8.0, 10.0]
+    >>> index.close()
+    >>> flat.close()
+
+    The smoothed tables are converted as well.
+
+    >>> index = hdflib.PositionalData(fname=fname, index=conf.tempdata('test-flatlib-smooth.hdf'), update=True, sigmas=[5])
+    >>> flat  = FlatData( convert( index.index, conf.tempdata('test-flatlib-smooth.flat') ) )
+    >>> flat.smooth_levels( 'chr1' )
+    [(5, 1)]
+    >>> results = flat.query_smooth( 'chr1', 400, 410, sigma=5, fields=('idx', 'val') )
+    >>> list( results.idx ) == list( index.query_smooth( 'chr1', 400, 410, sigma=5 ).idx )
+    True
+    >>> results.step
+    1
+    >>> index.close()
+    >>> flat.close()
+    """
+    def __init__(self, index, fname=''):
+        self.fname = fname
+        self.index = index
+        self.db = None
+        # the memory maps do not need the HDF lock, only the caches are guarded
+        self.lock = threading.RLock()
+        self.open()
+
+    def open(self):
+        "Reads the header"
+        fp = file( os.path.join(self.index, HEADER), 'rt' )
+        self.header = json.load( fp )
+        fp.close()
+        self.samples = {}
+        self.cache = {}
+
+    def build(self):
+        raise Exception('flat indices are created with the convert function')
+
+    def merge(self, fname):
+        raise Exception('flat indices are read only')
+
+    def flat_table(self, name):
+        "Returns a table by its name in the header"
+        key = ('flat', name)
+        if key not in self.cache:
+            info = self.header['tables'][name]
+            path = os.path.join( self.index, *name.split('/') )
+            self.cache[key] = FlatTable( path=path, name=name, rows=info['rows'], columns=info['columns'], 
+                attrs=info.get('attrs', {}) )
+        return self.cache[key]
+
+    @property
+    def labels(self):
+        "Labels in the file"
+        labs = map( str, self.header['labels'] )
+        util.nice_sort( labs )
+        return labs
+
+    def table(self, label):
+        return self.flat_table( label )
+
+    def chromosome(self, label):
+        return self.flat_table( label )
+
+    def zoom_levels(self, label):
+        "Bin sizes of the summary tables available for a label"
+        levels = list( self.header['zoom'].get(label, []) )
+        levels.sort()
+        return levels
+
+    def zoom_table(self, label, binsize):
+        "Returns the summary table for a label at a given bin size"
+        return self.flat_table( zoom_name(label, binsize) )
+
+    def smooth_levels(self, label):
+        "The (sigma, step) pairs of the smoothed tables available for a label"
+        levels = [ tuple(level) for level in self.header.get('smooth', {}).get(label, []) ]
+        levels.sort()
+        return levels
+
+    def smooth_table(self, label, sigma):
+        "Returns the smoothed table for a label at a given sigma"
+        return self.flat_table( smooth_table_name(label, sigma) )
+
+    def close(self):
+        # the memory maps are closed when released
+        self.close_peaks()
+        self.samples = {}
+        self.cache = {}
+
+def zoom_name( label, binsize ):
+    "The name of a summary table"
+    return '%s/%s/bin%s' % (hdflib.ZOOM_GROUP, label, binsize)
+
+def smooth_table_name( label, sigma ):
+    "The name of a smoothed table"
+    return '%s/%s/%s' % (hdflib.SMOOTH_GROUP, label, hdflib.smooth_name(sigma))
+
+def write_table( table, path, size=hdflib.CHUNK ):
+    """
+    Writes each column of a pytables table into a file within path.
+    Returns the column names and types.
+    """
+    if not os.path.isdir( path ):
+        os.makedirs( path )
+    columns = []
+    for colname in table.colnames:
+        # the arrays are stored as little endian
+        dtype = table.coldtypes[colname].newbyteorder('<')
+        fp = file( os.path.join(path, colname), 'wb' )
+        for start in xrange(0, len(table), size):
+            values = table.read( start, start + size, field=colname )
+            values.astype( dtype ).tofile( fp )
+        fp.close()
+        columns.append( (colname, dtype.str) )
+    return columns
+
+def convert( inpname, outname ):
+    """
+    Converts an HDF index into a flat index stored in the outname directory.
+    Returns the path to the flat index.
+    """
+    logger.info("converting '%s' to '%s'" % (inpname, outname))
+    index = hdflib.PositionalData( fname='', index=inpname, nobuild=True )
+    header = dict( labels=index.labels, tables={}, zoom={}, smooth={} )
+
+    def store( name, table, attrs={} ):
+        path = os.path.join( outname, *name.split('/') )
+        columns = write_table( table, path=path )
+        header['tables'][name] = dict( rows=len(table), columns=columns, attrs=attrs )
+
+    for label in index.labels:
+        logger.info('writing %s' % label)
+        store( label, index.table(label) )
+        levels = index.zoom_levels( label )
+        for binsize in levels:
+            store( zoom_name(label, binsize), index.zoom_table(label, binsize) )
+        header['zoom'][label] = levels
+        levels = index.smooth_levels( label )
+        for sigma, step in levels:
+            store( smooth_table_name(label, sigma), index.smooth_table(label, sigma), attrs=dict(sigma=sigma, step=step) )
+        header['smooth'][label] = levels
+    index.close()
+
+    # the header is written last
+    fp = file( os.path.join(outname, HEADER), 'wt' )
+    json.dump( header, fp )
+    fp.close()
+    return outname
+
+def test( verbose=0 ):
+    """
+    Test runner
+    """
+    import doctest
+    doctest.testmod(optionflags=doctest.ELLIPSIS)
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,268 @@
+"""
+Reading of gzip and bgzip compressed inputs.
+
+The `open_input` function opens plain, gzip and bgzip compressed
+files alike, the compressed files are decompressed while being read.
+The bgzip files (see the SAM format specification) consist
+of independent gzip members of at most 64KB, these blocks
+are decompressed in parallel by a pool of threads.
+
+>>> from genetrack import conf
+>>> fname = conf.testdata('short-data.bed')
+>>> gzname = bgzip( fname, conf.tempdata('short-data.bed.gz'), size=2**12 )
+>>> is_gzip( gzname ), is_bgzip( gzname ), is_bgzip( fname )
+(True, True, False)
+>>> fp = open_input( gzname, threads=2 )
+>>> fp.readline() + fp.read() == file( fname ).read()
+True
+>>> fp.close()
+
+The gzip files are decompressed as a stream
+
+>>> import gzip
+>>> gzname = conf.tempdata('short-data.gz')
+>>> out = gzip.open( gzname, 'wb' )
+>>> out.writelines( file(fname) )
+>>> out.close()
+>>> is_gzip( gzname ), is_bgzip( gzname )
+(True, False)
+>>> fp = open_input( gzname )
+>>> list( fp ) == list( file(fname) )
+True
+>>> fp.close()
+"""
+import zlib, struct
+from cStringIO import StringIO
+from itertools import *
+
+# the first two bytes of gzip files
+MAGIC = '\x1f\x8b'
+
+# the number of threads that decompress the blocks of bgzip files
+THREADS = 4
+
+# the number of bgzip blocks that are decompressed in one batch
+BATCH = 256
+
+# the size of the reads from the compressed files
+BLOCK = 2**20
+
+# the compressed files are assumed to be this many times smaller, used in estimates
+RATIO = 4
+
+# the gzip members are decompressed with this window
+WBITS = 16 + zlib.MAX_WBITS
+
+def is_gzip( fname ):
+    "Returns True for gzip (and bgzip) compressed files"
+    fp = file(fname, 'rb')
+    head = fp.read( 2 )
+    fp.close()
+    return head == MAGIC
+
+def block_size( head, extra ):
+    """
+    Returns the size of a bgzip block from its header and extra field,
+    None when the extra field does not have the BC subfield
+    """
+    if head[:2] != MAGIC or not ord(head[3]) & 4:
+        return None
+    pos = 0
+    while pos + 4 <= len(extra):
+        slen = struct.unpack( '<H', extra[pos + 2:pos + 4] )[0]
+        if extra[pos:pos + 2] == 'BC' and slen == 2:
+            return struct.unpack( '<H', extra[pos + 4:pos + 6] )[0] + 1
+        pos += 4 + slen
+    return None
+
+def read_header( fp ):
+    "Reads the fixed header and the extra field of a gzip member"
+    head = fp.read( 12 )
+    if len(head) < 12:
+        return head, ''
+    xlen = struct.unpack( '<H', head[10:12] )[0]
+    return head, fp.read( xlen )
+
+def is_bgzip( fname ):
+    "Returns True for bgzip compressed files"
+    fp = file(fname, 'rb')
+    head, extra = read_header( fp )
+    fp.close()
+    return len(head) == 12 and block_size( head, extra ) is not None
+
+def bgzip_blocks( fp ):
+    "Generates the compressed blocks of a bgzip file"
+    while True:
+        head, extra = read_header( fp )
+        if not head:
+            break
+        size = block_size( head, extra )
+        if size is None:
+            raise IOError('invalid bgzip block at offset %s' % fp.tell())
+        yield head + extra + fp.read( size - len(head) - len(extra) )
+
+def inflate( block ):
+    "Decompresses a gzip member, runs in the threads"
+    return zlib.decompress( block, WBITS )
+
+def bgzip_chunks( fname, threads=THREADS ):
+    """
+    Generates the decompressed content of a bgzip file in batches of blocks.
+    The next batch is decompressed while the previous one is consumed.
+    """
+    from multiprocessing.pool import ThreadPool
+
+    fp = file(fname, 'rb')
+    pool = ThreadPool( threads )
+    try:
+        blocks = bgzip_blocks( fp )
+        pending = None
+        while True:
+            batch = list( islice(blocks, BATCH) )
+            result = batch and pool.map_async( inflate, batch )
+            if pending:
+                yield ''.join( pending.get() )
+            if not batch:
+                break
+            pending = result
+    finally:
+        pool.terminate()
+        fp.close()
+
+def gzip_chunks( fname ):
+    "Generates the decompressed content of a gzip file, the members may be concatenated"
+    fp = file(fname, 'rb')
+    try:
+        inflater = zlib.decompressobj( WBITS )
+        for data in iter( lambda: fp.read(BLOCK), '' ):
+            while data:
+                yield inflater.decompress( data )
+                # a new member starts after the end of the previous one
+                data = inflater.unused_data
+                if data:
+                    inflater = zlib.decompressobj( WBITS )
+        yield inflater.flush()
+    finally:
+        fp.close()
+
+class ChunkReader( object ):
+    """
+    A read only file-like object over an iterator of strings.
+    Supports read, readline, iteration over the lines and tell.
+    """
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.buffer, self.pos, self.offset = '', 0, 0
+        self.closed = False
+
+    def next_chunk(self):
+        "Returns the next non empty chunk or None at the end"
+        for chunk in self.chunks:
+            if chunk:
+                return chunk
+        return None
+
+    def read(self, size=-1):
+        parts = [ self.buffer[self.pos:] ]
+        count = len(parts[0])
+        while size < 0 or count < size:
+            chunk = self.next_chunk()
+            if chunk is None:
+                break
+            parts.append( chunk )
+            count += len(chunk)
+        data = ''.join( parts )
+        if size >= 0:
+            data, self.buffer = data[:size], data[size:]
+        else:
+            self.buffer = ''
+        self.pos = 0
+        self.offset += len(data)
+        return data
+
+    def readline(self):
+        while True:
+            end = self.buffer.find( '\n', self.pos )
+            if end >= 0:
+                line = self.buffer[self.pos:end + 1]
+                self.pos = end + 1
+                break
+            chunk = self.next_chunk()
+            if chunk is None:
+                line = self.buffer[self.pos:]
+                self.buffer, self.pos = '', 0
+                break
+            self.buffer, self.pos = self.buffer[self.pos:] + chunk, 0
+        self.offset += len(line)
+        return line
+
+    def __iter__(self):
+        # the complete lines of the buffer are split in one step
+        while True:
+            end = self.buffer.rfind( '\n' )
+            if end >= self.pos:
+                body = self.buffer[self.pos:end + 1]
+                self.buffer, self.pos = self.buffer[end + 1:], 0
+                self.offset += len(body)
+                for line in StringIO( body ):
+                    yield line
+            chunk = self.next_chunk()
+            if chunk is None:
+                break
+            self.buffer, self.pos = self.buffer[self.pos:] + chunk, 0
+        
+        # the file may not end with a newline
+        rest = self.buffer[self.pos:]
+        self.buffer, self.pos = '', 0
+        if rest:
+            self.offset += len(rest)
+            yield rest
+
+    def tell(self):
+        "The offset in the decompressed content"
+        return self.offset
+
+    def close(self):
+        if not self.closed:
+            self.chunks.close()
+            self.closed = True
+
+def open_input( fname, mode='rb', threads=THREADS ):
+    """
+    Opens a file for reading, gzip and bgzip compressed files
+    are decompressed while being read. The mode is used for
+    the plain files, the compressed ones are read as binary.
+    """
+    if is_bgzip( fname ):
+        return ChunkReader( bgzip_chunks( fname, threads=threads ) )
+    elif is_gzip( fname ):
+        return ChunkReader( gzip_chunks( fname ) )
+    else:
+        return file(fname, mode)
+
+def bgzip( inpname, outname, size=2**16 - 2**10, level=6 ):
+    """
+    Compresses a file into the bgzip format, each block
+    holds size bytes of the input. Returns the outname.
+    """
+    inp, out = file(inpname, 'rb'), file(outname, 'wb')
+    # the empty block marks the end of the file
+    for data in chain( iter( lambda: inp.read(size), '' ), [ '' ] ):
+        packer = zlib.compressobj( level, zlib.DEFLATED, -zlib.MAX_WBITS )
+        body = packer.compress( data ) + packer.flush()
+        head = MAGIC + '\x08\x04' + '\x00' * 4 + '\x00\xff' + struct.pack( '<H2sHH', 6, 'BC', 2, len(body) + 25 )
+        tail = struct.pack( '<II', zlib.crc32( data ) & 0xffffffffL, len(data) )
+        out.write( head + body + tail )
+    inp.close()
+    out.close()
+    return outname
+
+def test( verbose=0 ):
+    """
+    Test runner
+    """
+    import doctest
+    doctest.testmod(optionflags=doctest.ELLIPSIS)
+
+if __name__ == "__main__":
+    test()
@@ -2,11 +2,13 @@
 Utilities for the hierarchical data format (HDF).
 
 """
-from tables import openFile
-from tables import IsDescription, IntCol, FloatCol
-from genetrack import logger, util, conf
+from tables import openFile, Filters
+from tables import IsDescription, IntCol, FloatCol, UInt32Col, Float32Col
+from genetrack import logger, util, conf, fitlib, gziplib
 from itertools import *
-import os, bisect, gc, csv
+from operator import itemgetter
+import os, threading
+import numpy
 
 # missing file
 missing = lambda f: not os.path.isfile(f)
@@ -14,6 +16,45 @@ missing = lambda f: not os.path.isfile(f)
 # prints messages after processing chunk  number of lines
 CHUNK = 10**5 
 
+# every SAMPLE-th index is kept in memory to speed up the searches
+SAMPLE = 1024
+
+# the size of the blocks read when parsing the input
+BLOCK = 2**24
+
+# the number of open indices kept in the IndexPool
+POOL_SIZE = 20
+
+# the fields of the positional data
+FIELDS = ( 'idx', 'fwd', 'rev', 'val' )
+
+# bin sizes for the pre-aggregated summary tables (zoom levels)
+ZOOM_LEVELS = [ 10, 100, 1000, 10000, 100000 ]
+
+# the summary tables are stored under this group, one subgroup per label
+ZOOM_GROUP = 'zoom'
+
+# the smoothed tables are stored under this group, one subgroup per label
+SMOOTH_GROUP = 'smooth'
+
+# the smoothed values below this are not stored
+SMOOTH_EPSILON = 0.01
+
+# the HDF5 library may not be called from several threads at 
+# once, the instances that read HDF files share this lock
+HDF_LOCK = threading.RLock()
+
+def locked( func ):
+    "Runs a method while holding the lock attribute of the instance"
+    def wrapper( self, *args, **kwds ):
+        self.lock.acquire()
+        try:
+            return func( self, *args, **kwds )
+        finally:
+            self.lock.release()
+    wrapper.__name__, wrapper.__doc__ = func.__name__, func.__doc__
+    return wrapper
+
 class PositionalSchema( IsDescription ):
     """
     Stores a triplet of float values for each index. 
@@ -24,7 +65,559 @@ class PositionalSchema( IsDescription ):
     rev = FloatCol( pos=3 )  # value on the reverse strand
     val = FloatCol( pos=4 )  # weighted value on the combined strands
 
-class PositionalData(object):
+class CompactSchema( IsDescription ):
+    """
+    A smaller variant of the PositionalSchema. Stores the index as 
+    an unsigned 32 bit integer and the values as 32 bit floats.
+    """
+    idx = UInt32Col ( pos=1 )  # index
+    fwd = Float32Col( pos=2 )  # values on the forward strand
+    rev = Float32Col( pos=3 )  # value on the reverse strand
+    val = Float32Col( pos=4 )  # weighted value on the combined strands
+
+def make_filters( complib=None, complevel=5, shuffle=True ):
+    """
+    Returns the compression filters for the tables. The complib 
+    may be one of zlib, lzo, bzip2 or blosc, when not set 
+    the data will not be compressed.
+
+    >>> make_filters() is None
+    True
+    >>> filters = make_filters('zlib', complevel=1)
+    >>> filters.complib, filters.complevel, filters.shuffle
+    ('zlib', 1, True)
+    """
+    if not complib:
+        return None
+    return Filters( complevel=complevel, complib=complib, shuffle=shuffle )
+
+def estimate_rows( fname, lines=1000, size=None ):
+    """
+    Estimates the number of rows in a file from its size
+    and the average length of the first lines. When the size 
+    is specified it estimates the rows in that many bytes.
+    Compressed files are assumed to be `gziplib.RATIO` times smaller.
+    """
+    fp = gziplib.open_input(fname)
+    sample = [ len(line) for line in islice(fp, lines) ]
+    fp.close()
+    if not sample:
+        return 0
+    average = float( sum(sample) ) / len(sample)
+    if not size:
+        size = os.path.getsize(fname)
+        if gziplib.is_gzip(fname):
+            size *= gziplib.RATIO
+    return int( size / average )
+
+def parse_block( text ):
+    """
+    Parses a block of text in the positional format (without the header). 
+    The numeric columns are converted in one step, then the rows are 
+    split into runs that belong to the same label. Returns a list 
+    of (label, values) tuples where values is an array 
+    with one row for each line and the columns index, forward, 
+    reverse and value.
+
+    >>> text = 'chr1\\t10\\t1.0\\t0.0\\t1.0\\nchr1\\t12\\t0.0\\t2.0\\t2.0\\r\\nchr2\\t5\\t1.0\\t1.0\\t2.0\\n'
+    >>> for label, values in parse_block(text):
+    ...     print label, values.tolist()
+    chr1 [[10.0, 1.0, 0.0, 1.0], [12.0, 0.0, 2.0, 2.0]]
+    chr2 [[5.0, 1.0, 1.0, 2.0]]
+    """
+    words = text.split()
+    if len(words) % 5:
+        raise ValueError('each line must have 5 columns: %s' % text[:100])
+    
+    labels = words[0::5]
+    if not labels:
+        return []
+
+    # leaves only the numeric columns
+    del words[0::5]
+    values = numpy.fromstring( ' '.join(words), dtype=numpy.float64, sep=' ' )
+    if len(values) != len(words):
+        raise ValueError('invalid numeric value near: %s' % words[len(values)] )
+    values = values.reshape( (len(labels), 4) )
+
+    # the rows where a new label starts
+    marks = numpy.array( labels )
+    starts = [ 0 ] + list( (marks[1:] != marks[:-1]).nonzero()[0] + 1 ) + [ len(labels) ]
+    return [ (labels[lo], values[lo:hi]) for lo, hi in izip(starts, starts[1:]) ]
+
+def make_rows( values, dtype ):
+    "Transforms a values array returned by parse_block into a record array"
+    rows = numpy.empty( len(values), dtype=dtype )
+    for pos, name in enumerate( FIELDS ):
+        rows[name] = values[:, pos]
+    return rows
+
+def skip_header( fp ):
+    "Unwinds an open file until it hits the header, returns the offset of the data"
+    for line in iter( fp.readline, '' ):
+        if line.startswith('chrom'):
+            break
+    return fp.tell()
+
+def parse_file( fname, size=BLOCK, start=None, end=None ):
+    """
+    Generates (label, values) tuples from a file in the positional format,
+    see `parse_block`. The lines preceding the header are skipped, the 
+    rest of the file is read in blocks of the given size that are cut 
+    at line endings.
+
+    When start and end are specified only the lines within this byte 
+    range are parsed, start must be at the beginning of a line.
+    Otherwise the file may be gzip or bgzip compressed, see `gziplib`.
+    """
+    if start is None:
+        fp = gziplib.open_input(fname)
+        skip_header( fp )
+    else:
+        fp = file(fname, 'rb')
+        fp.seek( start )
+
+    rest = ''
+    while True:
+        if end is not None:
+            size = min( size, end - fp.tell() )
+        block = size > 0 and fp.read( size )
+        if not block:
+            break
+        block = rest + block
+        
+        # the last line may continue in the next block
+        pos = block.rfind('\n') + 1
+        block, rest = block[:pos], block[pos:]
+        for result in parse_block( block ):
+            yield result
+    
+    # the file may not end with a newline
+    for result in parse_block( rest ):
+        yield result
+
+    fp.close()
+
+def scan_labels( fname, limit=2**16 ):
+    """
+    Finds the byte ranges occupied by each label in a file in the positional 
+    format. The labels must be in consecutive lines, the boundaries are located 
+    by bisection over the file offsets, ranges that are under the limit 
+    are scanned line by line. Returns a list of (label, start, end) tuples.
+
+    >>> from genetrack import conf
+    >>> fname = conf.testdata('test-hdflib-input.txt')
+    >>> ranges = scan_labels( fname )
+    >>> [ label for label, start, end in ranges ]
+    ['chr1', 'chr2', 'chr3']
+    >>> [ label for label, values in parse_file(fname, start=ranges[1][1], end=ranges[1][2]) ]
+    ['chr2']
+    """
+    fp = file(fname, 'rb')
+    first = skip_header( fp )
+    last  = os.path.getsize( fname )
+    
+    # the label of a line, None for the end of the file
+    label_of = lambda line: line.split('\t')[0].strip() or None
+
+    def label_at( offset ):
+        "Returns the start and the label of the first line at or after the offset"
+        fp.seek( max(offset - 1, 0) )
+        if offset:
+            fp.readline()
+        start = fp.tell()
+        return start, label_of( fp.readline() )
+
+    def scan( lo, hi, lab_hi ):
+        "Returns the offsets of the lines in lo, hi that start a new label"
+        fp.seek( lo )
+        marks, last = [], None
+        for line in fp.read( hi - lo ).splitlines(True):
+            label = label_of( line )
+            if last and label != last:
+                marks.append( lo )
+            last = label
+            lo += len( line )
+        if lab_hi != last:
+            marks.append( hi )
+        return marks
+
+    def bisection( lo, lab_lo, hi, lab_hi ):
+        # all lines between two lines with the same label have that label
+        if lab_lo == lab_hi:
+            return []
+        mid, lab_mid = label_at( (lo + hi) / 2 )
+        if hi - lo < limit or mid >= hi:
+            return scan( lo, hi, lab_hi )
+        return bisection( lo, lab_lo, mid, lab_mid ) + bisection( mid, lab_mid, hi, lab_hi )
+
+    # the end of the file is marked with the None label
+    marks = [ first ] + bisection( first, label_at( first )[1], last, None )
+    
+    ranges = []
+    for start, end in izip( marks, marks[1:] ):
+        label = label_at( start )[1]
+        if label:
+            ranges.append( (label, start, end) )
+    fp.close()
+
+    labels = [ label for label, start, end in ranges ]
+    if len(labels) != len(set(labels)):
+        raise ValueError('the labels must be in consecutive lines in %s' % fname)
+    return ranges
+
+class ZoomSchema( IsDescription ):
+    """
+    Stores the summary of the positional data that falls into a bin.
+    """
+    idx = IntCol  ( pos=1 )  # start of the bin
+    cnt = IntCol  ( pos=2 )  # number of indices in the bin
+    fwd = FloatCol( pos=3 )  # sum of the values on the forward strand
+    rev = FloatCol( pos=4 )  # sum of the values on the reverse strand
+    val = FloatCol( pos=5 )  # sum of the values on the combined strands
+    fwdmax = FloatCol( pos=6 )  # maximal value on the forward strand
+    revmax = FloatCol( pos=7 )  # maximal value on the reverse strand
+    valmax = FloatCol( pos=8 )  # maximal value on the combined strands
+
+# columns that are summed and columns that are maximized when binning
+ZOOM_SUMS = ( 'cnt', 'fwd', 'rev', 'val' )
+ZOOM_MAXS = ( 'fwdmax', 'revmax', 'valmax' )
+
+def zoom_dtype():
+    "The numpy record type that corresponds to the ZoomSchema"
+    return numpy.dtype([ ('idx', numpy.int32), ('cnt', numpy.int32) ] +
+        [ (name, numpy.float64) for name in ( 'fwd', 'rev', 'val', 'fwdmax', 'revmax', 'valmax' ) ])
+
+def zoom_rows( rows ):
+    """
+    Transforms positional rows (with idx, fwd, rev and val fields) 
+    into zoom rows where each index is a bin of its own.
+    """
+    data = numpy.zeros( len(rows), dtype=zoom_dtype() )
+    data['idx'] = rows['idx']
+    data['cnt'] = 1
+    for name in ( 'fwd', 'rev', 'val' ):
+        data[name] = data[name + 'max'] = rows[name]
+    return data
+
+def summarize( data, binsize ):
+    """
+    Aggregates zoom rows into bins of a given size. The counts and 
+    the values are summed, the maxima are maximized. The rows 
+    must be sorted by index.
+
+    >>> rows = numpy.zeros( 4, dtype=[ ('idx', int), ('fwd', float), ('rev', float), ('val', float) ] )
+    >>> rows['idx'] = [ 1, 5, 12, 31 ]
+    >>> rows['fwd'] = [ 1, 2, 3, 4 ]
+    >>> rows['val'] = rows['fwd']
+    >>> bins = summarize( zoom_rows(rows), binsize=10 )
+    >>> list(bins['idx'])
+    [0, 10, 30]
+    >>> list(bins['cnt'])
+    [2, 1, 1]
+    >>> list(bins['fwd'])
+    [3.0, 3.0, 4.0]
+    >>> list(bins['fwdmax'])
+    [2.0, 3.0, 4.0]
+    """
+    if not len(data):
+        return data
+
+    # rows that start a new bin
+    bins  = data['idx'] // binsize
+    flags = numpy.ones( len(bins), bool )
+    flags[1:] = bins[1:] != bins[:-1]
+    starts = flags.nonzero()[0]
+
+    result = numpy.zeros( len(starts), dtype=data.dtype )
+    result['idx'] = bins.take(starts) * binsize
+    for name in ZOOM_SUMS:
+        result[name] = numpy.add.reduceat( data[name], starts )
+    for name in ZOOM_MAXS:
+        result[name] = numpy.maximum.reduceat( data[name], starts )
+    return result
+
+def load_table( db, label, runs, schema=PositionalSchema, filters=None, expectedrows=10000, sigmas=(), step=1 ):
+    """
+    Creates the table of a label from an iterator over value 
+    arrays (see `parse_block`) then builds its summary tables
+    and the smoothed tables for each sigma.
+    """
+    table = db.createTable( "/", label, schema, 'label %s' % label, 
+        filters=filters, expectedrows=expectedrows )
+    logger.info("creating table:%s" % label)
+
+    for values in runs:
+        table.append( make_rows( values, dtype=table.dtype ) )
+        # prints progress on processing
+        logger.info("... processed %s lines" % util.commify( len(table) ))    
+    
+    # commit the changes
+    table.flush()
+    logger.info('table=%s, contains %s rows' % (label, util.commify( len(table) )) )
+    build_zoom( db=db, table=table, label=label, filters=filters )
+    if sigmas:
+        build_smooth( db=db, table=table, label=label, sigmas=sigmas, step=step, filters=filters )
+    return table
+
+def merge_values( values, other ):
+    """
+    Merges two value arrays (see `parse_block`) that are sorted 
+    by index. The values at identical indices are summed.
+
+    >>> values = numpy.array( [ [1, 1, 0, 1], [5, 0, 1, 1] ], numpy.float64 )
+    >>> other  = numpy.array( [ [2, 1, 0, 1], [5, 1, 0, 1] ], numpy.float64 )
+    >>> merge_values( values, other ).tolist()
+    [[1.0, 1.0, 0.0, 1.0], [2.0, 1.0, 0.0, 1.0], [5.0, 1.0, 1.0, 2.0]]
+    """
+    data = numpy.concatenate( (values, other) )
+    data = data.take( data[:, 0].argsort(kind='mergesort'), axis=0 )
+
+    # rows that start a new index
+    index = data[:, 0]
+    flags = numpy.ones( len(index), bool )
+    flags[1:] = index[1:] != index[:-1]
+    starts = flags.nonzero()[0]
+
+    result = numpy.add.reduceat( data, starts, axis=0 )
+    result[:, 0] = index.take( starts )
+    return result
+
+def table_values( table, size=CHUNK ):
+    "Generates the rows of a positional table as value arrays (see `parse_block`) in blocks of size rows"
+    for start in xrange(0, len(table), size):
+        rows = table.read( start, start + size )
+        yield numpy.column_stack( [ rows[name] for name in FIELDS ] ).astype( numpy.float64 )
+
+def merge_runs( runs, other ):
+    """
+    Merges two iterators over value arrays that are sorted by index, 
+    yields the merged values in blocks, see `merge_values`. Only one
+    block of each input is held in memory.
+
+    >>> runs  = [ numpy.array( [ [1, 1, 0, 1], [4, 1, 0, 1] ], numpy.float64 ), numpy.array( [ [6, 0, 1, 1] ], numpy.float64 ) ]
+    >>> other = [ numpy.array( [ [2, 1, 0, 1], [4, 0, 1, 1], [9, 1, 0, 1] ], numpy.float64 ) ]
+    >>> [ values[:, 0].tolist() for values in merge_runs( runs, other ) ]
+    [[1.0, 2.0, 4.0], [6.0], [9.0]]
+    >>> numpy.concatenate( list( merge_runs( runs, other ) ) )[:, 3].tolist()
+    [1.0, 1.0, 2.0, 1.0, 1.0]
+    """
+    inputs = [ iter(runs), iter(other) ]
+    empty  = numpy.zeros( (0, 4), numpy.float64 )
+    blocks = [ empty, empty ]
+    active = [ True, True ]
+    while True:
+        # refill the consumed blocks
+        for pos, source in enumerate( inputs ):
+            while active[pos] and not len(blocks[pos]):
+                try:
+                    blocks[pos] = source.next()
+                except StopIteration:
+                    active[pos] = False
+        
+        if not sum( map(len, blocks) ):
+            break
+
+        # the indices up to the smallest last index of the 
+        # inputs that are not exhausted are complete
+        lasts = [ block[-1, 0] for block, flag in zip(blocks, active) if flag ]
+        if lasts:
+            bound = min( lasts )
+        else:
+            bound = max( [ block[-1, 0] for block in blocks if len(block) ] )
+
+        parts = []
+        for pos, block in enumerate( blocks ):
+            index = block[:, 0].searchsorted( bound, side='right' )
+            parts.append( block[:index] )
+            blocks[pos] = block[index:]
+        yield merge_values( *parts )
+
+def table_layout( db, label ):
+    """
+    Returns the schema, the filters, the sigmas and 
+    the step of the smoothed tables of a positional table
+    """
+    table = getattr( db.root, label )
+    sigmas, step = [], 1
+    if SMOOTH_GROUP in db.root._v_children and label in smooth_parent(db)._v_children:
+        group  = getattr( smooth_parent(db), label )
+        levels = [ (x.attrs.sigma, x.attrs.step) for x in group._f_listNodes(classname='Table') ]
+        sigmas = [ sigma for sigma, step in levels ]
+        step   = levels and levels[0][1] or 1
+    return table.dtype, table.filters, sigmas, step
+
+def repack( index ):
+    """
+    Rewrites an index into a new file. The HDF5 files do not reclaim the 
+    space of the removed tables, the copy only contains the live nodes.
+    Equivalent to running the ptrepack utility of PyTables.
+    """
+    tmpname = index + '.repack'
+    db = openFile( index, mode='r' )
+    try:
+        db.copyFile( tmpname, overwrite=True )
+    finally:
+        db.close()
+    os.remove( index )
+    os.rename( tmpname, index )
+
+def build_worker( params ):
+    """
+    Loads the lines of one label into a separate file, 
+    runs in the worker processes of a parallel build.
+    """
+    fname, label, start, end, tmpname, compact, filters, sigmas, step = params
+    schema = compact and CompactSchema or PositionalSchema
+    db = openFile( tmpname, mode='w', title='partial HDF index' )
+    runs = ( values for chrom, values in parse_file( fname, start=start, end=end ) )
+    load_table( db=db, label=label, runs=runs, schema=schema, filters=filters, 
+        expectedrows=estimate_rows( fname, size=end - start ), sigmas=sigmas, step=step )
+    db.close()
+    return label, tmpname
+
+def zoom_parent( db ):
+    "Returns the group that holds the summary tables, creates it if necessary"
+    if ZOOM_GROUP not in db.root._v_children:
+        db.createGroup( "/", ZOOM_GROUP, 'summary tables' )
+    return getattr( db.root, ZOOM_GROUP )
+
+def build_zoom( db, table, label, levels=ZOOM_LEVELS, size=CHUNK, filters=None ):
+    """
+    Creates the summary tables for a positional table, one table 
+    for each bin size in levels. The data is processed in chunks 
+    of size rows, each level is computed from the previous one.
+    The summary tables use the same filters as the positional tables.
+    """
+    group = db.createGroup( zoom_parent(db), label, 'summaries for %s' % label )
+
+    targets = []
+    for binsize in levels:
+        targets.append( db.createTable( group, 'bin%s' % binsize, ZoomSchema, 'bin size %s' % binsize, 
+            filters=filters, expectedrows=len(table) ) )
+
+    # the last bin of each level may continue in the following chunk
+    empty = numpy.zeros( 0, dtype=zoom_dtype() )
+    carry = [ empty ] * len(levels)
+
+    def cascade( data, final ):
+        for pos, (binsize, target) in enumerate( izip(levels, targets) ):
+            data = summarize( numpy.concatenate( (carry[pos], data) ), binsize )
+            if not final:
+                carry[pos], data = data[-1:], data[:-1]
+            if len(data):
+                target.append( data )
+
+    for start in xrange(0, len(table), size):
+        rows = table.read( start, start + size )
+        cascade( zoom_rows(rows), final=False )
+    cascade( empty, final=True )
+
+    for target in targets:
+        target.flush()
+
+def smooth_name( sigma ):
+    """
+    The name of the smoothed table for a sigma
+
+    >>> smooth_name( 20 ), smooth_name( 12.5 )
+    ('sigma20', 'sigma12_5')
+    """
+    return ( 'sigma%g' % sigma ).replace( '.', '_' )
+
+def smooth_parent( db ):
+    "Returns the group that holds the smoothed tables, creates it if necessary"
+    if SMOOTH_GROUP not in db.root._v_children:
+        db.createGroup( "/", SMOOTH_GROUP, 'smoothed tables' )
+    return getattr( db.root, SMOOTH_GROUP )
+
+def build_smooth( db, table, label, sigmas, step=1, size=CHUNK/10, filters=None, epsilon=SMOOTH_EPSILON ):
+    """
+    Creates the gaussian smoothed tables of a positional table, one table
+    for each sigma. The fwd, rev and val columns are smoothed separately, 
+    the positions where the smoothed val is over epsilon are stored. 
+    A step larger than one keeps only every step-th position.
+    The data is processed in chunks of size rows.
+    """
+    group = db.createGroup( smooth_parent(db), label, 'smoothed %s' % label )
+
+    def stream( sigma, name ):
+        # smoothing with a negative epsilon keeps all positions within the kernels
+        chunks = ( table.read( start, start + size ) for start in xrange(0, len(table), size) )
+        chunks = ( (rows['idx'], rows[name]) for rows in chunks )
+        return fitlib.smoothed_segments( chunks, sigma=sigma, epsilon=-1 )
+
+    for sigma in sigmas:
+        logger.info('smoothing %s with sigma=%s' % (label, sigma))
+        target = db.createTable( group, smooth_name(sigma), table.dtype, 'sigma %s' % sigma, 
+            filters=filters, expectedrows=len(table) )
+        target.attrs.sigma = sigma
+        target.attrs.step  = step
+        
+        streams = [ stream( sigma, name ) for name in FIELDS[1:] ]
+        for (x, fwd), (x, rev), (x, val) in izip( *streams ):
+            keep = val > epsilon
+            if step > 1:
+                keep &= ( x % step == 0 )
+            rows = numpy.zeros( keep.sum(), dtype=target.dtype )
+            for name, values in zip( FIELDS, (x, fwd, rev, val) ):
+                rows[name] = values[keep]
+            target.append( rows )
+        target.flush()
+
+def index_path( fname, workdir=None, index=None ):
+    """
+    Returns the path to the HDF index of a file. The index is placed 
+    next to the file or into the workdir if that is specified.
+    """
+    if index:
+        return index
+    
+    # split the incoming name to find the real name, and base directory
+    basedir, basename = os.path.split(fname)
+
+    # the index may be stored in the workdir if it was specified
+    basedir = workdir or basedir
+
+    return conf.path_join(basedir, '%s.hdf' % basename)
+
+class SortedSearch(object):
+    """
+    Searches the sorted columns of tables. The subclasses 
+    need a samples dictionary attribute.
+    """
+    def sample(self, table, colattr='idx'):
+        """
+        Returns every SAMPLE-th value of a table column. The samples
+        are loaded on the first access then kept in memory.
+        """
+        key = (table._v_pathname, colattr)
+        if key not in self.samples:
+            # the copy keeps the samples of memory mapped columns 
+            # in memory instead of touching a page per sample
+            column = getattr(table.cols, colattr)
+            self.samples[key] = numpy.array( column[::SAMPLE] )
+        return self.samples[key]
+
+    def search(self, table, value, colattr='idx'):
+        """
+        Returns the leftmost row index where the value could be inserted
+        into a sorted column, same as bisect.bisect_left on the column.
+        
+        The in-memory samples locate the block of SAMPLE rows that 
+        contains the position, then a single read of that block 
+        refines it.
+        """
+        pos = self.sample( table, colattr=colattr ).searchsorted( value )
+        
+        # the position falls after the previous sample and 
+        # no further than the current sample
+        lo = max( (pos - 1) * SAMPLE + 1, 0 )
+        hi = min( pos * SAMPLE, table.nrows )
+        block = getattr(table.cols, colattr)[lo:hi]
+        return lo + int( block.searchsorted( value ) )
+
+class PositionalData(SortedSearch):
     """
     An HFD representation of coordinates with one or more values associated with 
     each of these coordinates. The class can store such data for various labels (chromosomes). 
@@ -105,27 +698,49 @@ class PositionalData(object):
     >>> index.close()
     >>>
 
+    Each label also gets summary tables that hold the sums, maxima and counts 
+    of the values over bins of sizes listed in `ZOOM_LEVELS`. Wide regions 
+    may be queried with a number of pixels, see the `query` method.
+
     In order to provide the fastes parsing the internal parser
     is not overridable. There are transformers that can 
     change bed and gff files to this input format. See the 
     `genetrack.scripts' module.
     """
 
-    def __init__(self, fname, workdir=None, update=False, nobuild=False, index=None ):
+    # serializes the access to the HDF files, see the `locked` decorator
+    lock = HDF_LOCK
+
+    def __init__(self, fname, workdir=None, update=False, nobuild=False, index=None, 
+            complib=None, complevel=5, compact=False, workers=1, sigmas=(), step=1 ):
         """
         Create the PositionalData
+
+        The complib and complevel parameters set the compression of a newly built 
+        index (see `make_filters`), compact=True stores it with the `CompactSchema`.
+        With more than one worker the labels are built in parallel processes.
+        Smoothed tables are built for each of the sigmas, keeping every 
+        step-th position (see `build_smooth`).
         """
         self.fname = fname
         self.db = None
-        
-        # split the incoming name to find the real name, and base directory
-        basedir, basename = os.path.split(self.fname)
 
-        # the index may be stored in the workdir if it was specified
-        basedir = workdir or basedir
+        # the layout used when building the index
+        self.filters = make_filters( complib=complib, complevel=complevel )
+        self.compact = compact
+        self.schema  = compact and CompactSchema or PositionalSchema
+        self.workers = workers
+        self.sigmas  = sigmas
+        self.step    = step
+
+        # sampled columns used in searching, see the sample method
+        self.samples = {}
 
+        # caches the labels, the tables and the zoom levels
+        self.cache = {}
+        
         # this is the HDF index name that the file operates on
-        self.index = index or conf.path_join(basedir, '%s.hdf' % basename)
+        self.index = index_path( fname=self.fname, workdir=workdir, index=index )
 
         # debug messages
         logger.debug('file path %s' % self.fname)
@@ -140,12 +755,19 @@ class PositionalData(object):
             self.build()
 
         # operates on the HDF file
-        self.db=openFile(self.index, mode='r')
-        self.root = self.db.root
+        self.open()
         
         # shows the internal labels
         logger.debug('index labels -> %s' % self.labels)
 
+    @locked
+    def open(self):
+        "Opens the index for reading"
+        self.db=openFile(self.index, mode='r')
+        self.root = self.db.root
+        self.samples = {}
+        self.cache = {}
+
     def build(self):
         "May be overriden to use different parsers and schemas"
 
@@ -159,60 +781,28 @@ class PositionalData(object):
         # provides timing information
         timer = util.Timer()
 
-        # iterate over the file 
-        reader = csv.reader( file(self.fname, 'rt'), delimiter='\t' )
-    
-        # unwind the reader until it hits the header
-        for row in reader:
-            if row[0] == 'chrom':
-                break
-
-        # helper function that flushes a table
-        def flush( table, collect, name ):
-            # commit the changes
-            if collect:
-                table.append(collect)
-                table.flush() 
-                # nicer information
-                size = util.commify( len(table) )
-                logger.info('table=%s, contains %s rows' % (name, size) )
-            
-        # print messages at every CHUNK line
-        last_chrom = table = None
         db = openFile( self.index, mode='w', title='HDF index database')
 
-        # continue on with reading, optimized for throughput
-        # with minimal function calls
-        collect = []
-        for linec, row in izip(count(1), reader):
+        # the labels of compressed files cannot be located by their offsets
+        parallel = self.workers > 1
+        if parallel and gziplib.is_gzip( self.fname ):
+            logger.info('compressed input, building with one worker')
+            parallel = False
+
+        if parallel:
+            linec = self.build_parallel( db )
+        else:
+            # the chunk sizes of the tables are tuned for the expected number 
+            # of rows of each label, the rows for the whole file are an upper limit
+            estimates = self.expected_rows()
+
+            linec = 0
+            for label, values in self.label_runs():
+                expectedrows = estimates.get( label ) or estimate_rows( self.fname )
+                table = load_table( db=db, label=label, runs=values, schema=self.schema,
+                    filters=self.filters, expectedrows=expectedrows, sigmas=self.sigmas, step=self.step )
+                linec += len(table)
 
-            # prints progress on processing, also flushes to periodically
-            if (linec % CHUNK) == 0:
-               logger.info("... processed %s lines" % util.commify(linec))    
-               flush( table=table, collect=collect, name=last_chrom )
-               collect = []
-            
-            # get the values from each row
-            chrom, index, fwd, rev, value = row
-            fwd, rev, value = float(fwd), float(rev), float(value)
-        
-            # flush when switching chromosomes
-            if chrom != last_chrom:
-                # table==None at the beginning
-                if table is not None:
-                    #logger.debug("... flushing at line %s" % row)   
-                    flush( table=table, collect=collect, name=last_chrom )
-                    collect = []
-
-                # creates the new HDF table here
-                table = db.createTable(  "/", chrom, PositionalSchema, 'label %s' % chrom )
-                logger.info("creating table:%s" % chrom)
-                last_chrom = chrom
-
-            collect.append( (index, fwd, rev, value) )
-                           
-        # flush for last chromosome, report some timing information
-        flush(table, collect, chrom)
         lineno = util.commify(linec)
         elapsed = timer.report()
         logger.info("finished inserting %s lines in %s" % (lineno, elapsed) )
@@ -220,66 +810,393 @@ class PositionalData(object):
         # close database
         db.close()
 
+    def label_runs(self):
+        """
+        Generates (label, runs) tuples where runs iterates over the value 
+        arrays of the label (see `parse_block`). May be overriden to use 
+        different parsers.
+        """
+        # the file is parsed in blocks, each block is split 
+        # into runs of rows that belong to the same label
+        for label, runs in groupby( parse_file( self.fname ), key=itemgetter(0) ):
+            yield label, ( values for chrom, values in runs )
+
+    def expected_rows(self):
+        """
+        Returns the estimated number of rows keyed by label. Compressed 
+        files are not scanned, their labels get the estimate for the 
+        whole file. May be overriden along with `label_runs`.
+        """
+        if gziplib.is_gzip( self.fname ):
+            return {}
+        ranges = scan_labels( self.fname )
+        return dict( [ (label, estimate_rows( self.fname, size=end - start )) for label, start, end in ranges ] )
+
+    def build_parallel(self, db):
+        """
+        Builds the tables of each label in a pool of worker processes, 
+        each worker writes into a temporary file next to the index.
+        The tables are then copied into the index in the original order. 
+        Returns the number of rows.
+        """
+        import multiprocessing
+
+        tasks = []
+        for label, start, end in scan_labels( self.fname ):
+            tmpname = '%s.%s.tmp' % (self.index, label)
+            tasks.append( (self.fname, label, start, end, tmpname, self.compact, self.filters, self.sigmas, self.step) )
+        
+        logger.info('building %s labels with %s workers' % (len(tasks), self.workers))
+        pool = multiprocessing.Pool( self.workers )
+        try:
+            rows = 0
+            for label, tmpname in pool.imap( build_worker, tasks ):
+                part = openFile( tmpname, mode='r' )
+                table = getattr( part.root, label )
+                table.copy( newparent=db.root, newname=label )
+                zoom = getattr( getattr(part.root, ZOOM_GROUP), label )
+                zoom._f_copy( newparent=zoom_parent(db), recursive=True )
+                if self.sigmas:
+                    smooth = getattr( getattr(part.root, SMOOTH_GROUP), label )
+                    smooth._f_copy( newparent=smooth_parent(db), recursive=True )
+                rows += len(table)
+                part.close()
+                os.remove( tmpname )
+        finally:
+            pool.terminate()
+
+        return rows
+
     @property
+    @locked
     def labels(self):
         "Labels in the file"
-        labs = [ x.name for x in self.root._f_listNodes() ]
-        util.nice_sort( labs )
-        return labs
+        if 'labels' not in self.cache:
+            labs = [ x.name for x in self.root._f_listNodes(classname='Table') ]
+            util.nice_sort( labs )
+            self.cache['labels'] = labs
+        return list( self.cache['labels'] )
     
-    def indices( self, label, start, end, colattr='idx'):
+    @locked
+    def indices( self, label, start, end, colattr='idx', binsize=0):
         """
         Returns the array indices that correspond the start, end values of index column
         
         Note that for this to work the values for the column attribute 'colattr' 
-        in the table must be sorted in increasing order 
+        in the table must be sorted in increasing order. A nonzero binsize 
+        will search the summary table of that bin size.
         """
-        table  = self.table( label )
-        column = getattr(table.cols, colattr)
-        istart = bisect.bisect_left( column, start )
-        iend   = bisect.bisect_left( column, end  )
+        if binsize:
+            table = self.zoom_table( label=label, binsize=binsize )
+        else:
+            table = self.table( label )
+        istart = self.search( table, start, colattr=colattr )
+        iend   = self.search( table, end, colattr=colattr )
         return istart, iend
 
-    def query(self, label, start, end, pad=0, aslist=False ):
+    @locked
+    def zoom_levels(self, label):
+        "Bin sizes of the summary tables available for a label"
+        key = ('levels', label)
+        if key not in self.cache:
+            group = self.zoom_group( label )
+            levels = []
+            if group is not None:
+                levels = [ int(x.name[3:]) for x in group._f_listNodes(classname='Table') ]
+                levels.sort()
+            self.cache[key] = levels
+        return self.cache[key]
+
+    def zoom_group(self, label):
+        "Returns the group holding the summary tables for a label or None"
+        try:
+            return getattr( getattr(self.root, ZOOM_GROUP), label )
+        except AttributeError:
+            return None
+
+    def zoom_table(self, label, binsize):
+        "Returns the summary table for a label at a given bin size"
+        key = ('zoom', label, binsize)
+        if key not in self.cache:
+            self.cache[key] = getattr( self.zoom_group(label), 'bin%s' % binsize )
+        return self.cache[key]
+
+    def smooth_group(self, label):
+        "Returns the group holding the smoothed tables for a label or None"
+        try:
+            return getattr( getattr(self.root, SMOOTH_GROUP), label )
+        except AttributeError:
+            return None
+
+    @locked
+    def smooth_levels(self, label):
+        "The (sigma, step) pairs of the smoothed tables available for a label"
+        key = ('smooth', label)
+        if key not in self.cache:
+            group = self.smooth_group( label )
+            levels = []
+            if group is not None:
+                levels = [ (x.attrs.sigma, x.attrs.step) for x in group._f_listNodes(classname='Table') ]
+                levels.sort()
+            self.cache[key] = levels
+        return self.cache[key]
+
+    def smooth_table(self, label, sigma):
+        "Returns the smoothed table for a label at a given sigma"
+        key = ('smooth', label, sigma)
+        if key not in self.cache:
+            self.cache[key] = getattr( self.smooth_group(label), smooth_name(sigma) )
+        return self.cache[key]
+
+    @locked
+    def query_smooth(self, label, start, end, sigma, fields=FIELDS, dtype=None):
+        """
+        Returns the precomputed smoothed data that spans start to end for a sigma, 
+        see the query method. Returns None when there is no table for the sigma.
+        The step attribute of the result tells the distance of the stored positions.
+
+        >>> from genetrack import conf
+        >>> fname = conf.testdata('test-hdflib-input.txt')
+        >>> index = PositionalData(fname=fname, index=conf.tempdata('test-hdflib-smooth.hdf'), update=True, sigmas=[5])
+        >>> index.smooth_levels( 'chr1' )
+        [(5, 1)]
+        >>> results = index.query_smooth( 'chr1', 400, 410, sigma=5, fields=('idx', 'val') )
+        >>> list( results.idx )
+        [400, 401, 402, 403, 404, 405, 406, 407, 408, 409]
+        >>> data = index.query( 'chr1', 0, 1000 )
+        >>> fx, fy = fitlib.gaussian_smoothing( data.idx, data.val, sigma=5, epsilon=SMOOTH_EPSILON )
+        >>> numpy.allclose( results.val, fy[ (fx >= 400) & (fx < 410) ] )
+        True
+        >>> index.query_smooth( 'chr1', 400, 410, sigma=20 ) is None
+        True
+        >>> index.close()
+        """
+        if sigma not in dict( self.smooth_levels(label) ):
+            return None
+        table  = self.smooth_table( label=label, sigma=sigma )
+        istart = self.search( table, start )
+        iend   = self.search( table, end )
+        params = self.read( table=table, start=istart, stop=iend, fields=fields, dtype=dtype )
+        params.step = table.attrs.step
+        return params
+
+    def binsize(self, label, start, end, pixels):
+        """
+        Returns the largest bin size that still produces at least
+        one bin per pixel over the interval, zero means that 
+        the raw data needs to be used
+        """
+        limit  = float(end - start) / pixels
+        levels = [ size for size in self.zoom_levels(label) if size <= limit ]
+        return max( levels or [0] )
+
+    @locked
+    def query(self, label, start, end, pad=0, aslist=False, pixels=None, stat='max', fields=FIELDS, dtype=None ):
         """
         Returns data that spans star to end as a class 
         with attributes for idx, fwd, rev and val
+
+        The rows are fetched with a single read, the attributes are views 
+        into the same record array. The fields parameter selects the 
+        attributes to return, leaving out the unused columns avoids 
+        the cost of transforming them into lists.
+
+        >>> from genetrack import conf
+        >>> fname = conf.testdata('test-hdflib-input.txt')
+        >>> index = PositionalData(fname=fname, workdir=conf.TEMP_DATA_DIR)
+        >>> results = index.query( 'chr1', 400, 600, fields=('idx', 'val'), aslist=True)
+        >>> results.idx
+        [402, 403, 411, 419, 427, 432, 434, 443, 587, 593, 596]
+        >>> results.val
+        [3.0, 1.0, 1.0, 1.0, 1.0, 2.0, 1.0, 1.0, 1.0, 1.0, 1.0]
+        >>> hasattr(results, 'fwd')
+        False
+
+        The values may be returned in a different precision, the index stays integer.
+
+        >>> results = index.query( 'chr1', 400, 600, fields=('idx', 'val'), dtype=numpy.float32)
+        >>> results.idx.dtype.kind, results.val.dtype
+        ('i', dtype('float32'))
+
+        When the number of pixels is specified the data will come from 
+        the coarsest summary table that still has at least one bin per pixel. 
+        In that case the idx attribute is the start of each bin and the 
+        values are either the maximum (stat='max') or the sum (stat='sum') 
+        over the bin. The binsize attribute of the result is zero for raw data.
+
+        >>> index.zoom_levels('chr1')
+        [10, 100, 1000, 10000, 100000]
+        >>> results = index.query( 'chr1', 0, 100000, pixels=100)
+        >>> results.binsize
+        1000
+        >>> list(results.idx[:3])
+        [0, 1000, 2000]
+        >>> list(results.val[:3])
+        [4.0, 8.0, 10.0]
+        >>> results = index.query( 'chr1', 0, 100000, pixels=100, stat='sum')
+        >>> list(results.val[:3])
+        [64.0, 110.0, 141.0]
+        >>> index.close()
         """
 
-        step  = 1
         table = self.table( label )
-        istart, iend = self.indices(label=label, start=start-pad, end=end+pad)
-
-        idx = table.cols.idx[istart:iend:step]
-        fwd = table.cols.fwd[istart:iend:step]
-        rev = table.cols.rev[istart:iend:step]
-        val = table.cols.val[istart:iend:step]
+        binsize = pixels and self.binsize( label=label, start=start, end=end, pixels=pixels )
         
-        # sometimes we need all return values to belists
-        if aslist:
-            idx, fwd, rev, val = map(list, (idx, fwd, rev, val))
+        # maps the attributes of the result to table columns
+        columns = dict( zip(FIELDS, FIELDS) )
+        if binsize:
+            # serve the data from the summary table
+            table = self.zoom_table( label=label, binsize=binsize )
+            start = start - start % binsize
+            if stat == 'max':
+                columns.update( fwd='fwdmax', rev='revmax', val='valmax' )
 
-        params = util.Params( idx=idx, fwd=fwd, rev=rev, val=val )
+        istart, iend = self.indices(label=label, start=start-pad, end=end+pad, binsize=binsize)
+
+        params = self.read( table=table, start=istart, stop=iend, fields=fields, columns=columns, aslist=aslist, dtype=dtype)
+        params.binsize = binsize or 0
         return params
     
-    def chunks(self, label, size=10**6, step=1 ):
+    @locked
+    def query_many(self, regions, fields=FIELDS, pad=0):
+        """
+        Returns the data for a list of (label, start, end) regions. The 
+        result has the fields as flat arrays that concatenate the data 
+        of the regions in their original order, and an offsets array 
+        where the data of the i-th region is between offsets[i] and offsets[i+1]. 
+
+        The regions are grouped by label and sorted, overlapping or 
+        adjacent regions are served from a single read.
+
+        >>> from genetrack import conf
+        >>> fname = conf.testdata('test-hdflib-input.txt')
+        >>> index = PositionalData(fname=fname, workdir=conf.TEMP_DATA_DIR)
+        >>> regions = [ ('chr1', 400, 450), ('chr2', 0, 100), ('chr1', 430, 600) ]
+        >>> results = index.query_many( regions, fields=('idx', 'val') )
+        >>> list(results.offsets)
+        [0, 8, 10, 16]
+        >>> list(results.idx[:8])
+        [402, 403, 411, 419, 427, 432, 434, 443]
+        >>> list(results.idx[8:10])
+        [79, 88]
+        >>> list(results.idx[10:])
+        [432, 434, 443, 587, 593, 596]
+        >>> index.close()
+        """
+        count  = len(regions)
+        labels = [ label for label, start, end in regions ]
+        starts = numpy.array( [ start for label, start, end in regions ], numpy.int64 ) - pad
+        ends   = numpy.array( [ end for label, start, end in regions ], numpy.int64 ) + pad
+        
+        # the row ranges of each region within the collected data
+        lo = numpy.zeros( count, numpy.int64 )
+        hi = numpy.zeros( count, numpy.int64 )
+        collect, size = [], 0
+
+        # the index is needed to locate the regions
+        columns = ( 'idx', ) + tuple( [ name for name in fields if name != 'idx' ] )
+        
+        # the positions of the regions for each label
+        groups = {}
+        for pos, label in enumerate( labels ):
+            groups.setdefault( label, [] ).append( pos )
+
+        for label, select in groups.items():
+            select = numpy.array( select, numpy.int64 )
+            select = select.take( starts.take(select).argsort(kind='mergesort') )
+            
+            # regions that do not overlap the previous ones start a new block
+            bstarts, bends = starts.take(select), ends.take(select)
+            reach = numpy.maximum.accumulate( bends )
+            flags = numpy.ones( len(select), bool )
+            flags[1:] = bstarts[1:] > reach[:-1]
+            marks = list( flags.nonzero()[0] ) + [ len(select) ]
+            
+            for first, last in izip( marks, marks[1:] ):
+                istart, iend = self.indices( label=label, start=bstarts[first], end=reach[last-1] )
+                data = self.read( table=self.table(label), start=istart, stop=iend, fields=columns )
+                
+                # locate the regions within the block
+                block = select[first:last]
+                lo[block] = size + data.idx.searchsorted( bstarts[first:last] ) 
+                hi[block] = size + data.idx.searchsorted( bends[first:last] )
+                collect.append( data )
+                size += iend - istart
+
+        # gathers the rows of each region in the original order
+        lengths = hi - lo
+        offsets = numpy.zeros( count + 1, numpy.int64 )
+        offsets[1:] = lengths.cumsum()
+        rows = numpy.arange( offsets[-1] ) + numpy.repeat( lo - offsets[:-1], lengths )
+        
+        params = util.Params( offsets=offsets )
+        for name in fields:
+            if collect:
+                values = numpy.concatenate( [ getattr(data, name) for data in collect ] )
+            else:
+                values = numpy.zeros( 0 )
+            setattr( params, name, values.take( rows ) )
+        return params
+
+    @locked
+    def read(self, table, start, stop, fields=FIELDS, columns={}, aslist=False, dtype=None):
+        """
+        Reads the rows from start to stop with a single read and returns 
+        the fields as attributes. The columns dictionary may map the fields 
+        to different column names. The values other than the index 
+        are converted to the dtype when it is specified.
+        """
+        params = util.Params()
+        if len(fields) == 1:
+            # a single column may be read by itself
+            name = fields[0]
+            data = { name: table.read( start, stop, field=columns.get(name, name) ) }
+            columns = {}
+        else:
+            data = table.read( start, stop )
+
+        for name in fields:
+            # the fields are views into the record array
+            values = data[ columns.get(name, name) ]
+
+            if dtype and name != 'idx':
+                values = values.astype( dtype )
+            
+            # sometimes we need all return values to belists
+            if aslist:
+                values = values.tolist()
+            setattr( params, name, values )
+        return params
+
+    def chunks(self, label, size=10**6, step=1, fields=FIELDS, aslist=True ):
         """
         Returns the data as chunks of size. All columns are
         simultaneously iterated over.
+
+        >>> from genetrack import conf
+        >>> fname = conf.testdata('test-hdflib-input.txt')
+        >>> index = PositionalData(fname=fname, workdir=conf.TEMP_DATA_DIR)
+        >>> chunks = index.chunks( 'chr3', size=1000, fields=('idx', 'val'), aslist=False )
+        >>> [ (len(idx), len(val)) for idx, val in chunks ]
+        [(1000, 1000), (1000, 1000), (198, 198)]
+        >>> index.close()
         """
         table = self.table( label )
         for start in xrange(0, 10**9, size):
-            end = start + size
-            idx = table.cols.idx[start:end:step].tolist()
-            if not idx:
+            end  = start + size
+            data = table.read( start, end, step )
+            if not len(data['idx']):
                 break
-            fwd = table.cols.fwd[start:end:step].tolist()
-            rev = table.cols.rev[start:end:step].tolist()
-            val = table.cols.val[start:end:step].tolist()        
-            yield idx, fwd, rev, val
+            if aslist:
+                yield [ data[name].tolist() for name in fields ]
+            else:
+                yield [ data[name] for name in fields ]
         
     def table(self, label):
-        return getattr( self.root, label )
+        key = ('table', label)
+        if key not in self.cache:
+            self.cache[key] = getattr( self.root, label )
+        return self.cache[key]
 
     def chromosome(self, label):
         """
@@ -289,13 +1206,209 @@ class PositionalData(object):
         return getattr( self.root, label )
 
 
+    @locked
+    def merge(self, fname, reclaim=True):
+        """
+        Merges the data from a file in the positional format into the index. 
+        The values at identical indices are summed. Only the labels that 
+        are present in the file are rewritten, returns these labels.
+        The existing tables and the file are merged in blocks, the input 
+        must be sorted by index within each label. The new labels take 
+        the layout and the smoothed tables of the existing ones, the 
+        stored peak predictions are outdated and are removed.
+
+        The space of the replaced tables is not reclaimed by HDF5, unless 
+        reclaim is False the index is repacked afterwards (see `repack`).
+
+        >>> from genetrack import conf
+        >>> import shutil
+        >>> fname = conf.testdata('test-hdflib-input.txt')
+        >>> index = conf.tempdata('test-hdflib-merge.hdf')
+        >>> data = PositionalData(fname=fname, index=index, update=True)
+        >>> data.merge( fname )
+        ['chr1', 'chr2', 'chr3']
+        >>> results = data.query( 'chr1', 400, 600)
+        >>> list(results.idx)
+        [402, 403, 411, 419, 427, 432, 434, 443, 587, 593, 596]
+        >>> list(results.val)
+        [6.0, 2.0, 2.0, 2.0, 2.0, 4.0, 2.0, 2.0, 2.0, 2.0, 2.0]
+        >>> data.close()
+        """
+        self.close()
+        db = openFile(self.index, mode='a')
+        try:
+            changed = []
+            estimate = estimate_rows( fname )
+
+            # the new labels follow the layout of the existing ones
+            labels = [ x.name for x in db.root._f_listNodes(classname='Table') ]
+            if labels:
+                layout = table_layout( db, labels[0] )
+            else:
+                layout = self.schema, self.filters, self.sigmas, self.step
+
+            for label, runs in groupby( parse_file( fname ), key=itemgetter(0) ):
+                values = ( values for chrom, values in runs )
+                schema, filters, sigmas, step = layout
+                expectedrows = estimate
+
+                # existing labels are merged into a new table
+                if label in db.root._v_children:
+                    # the smoothed tables are rebuilt with the same parameters
+                    schema, filters, sigmas, step = table_layout( db, label )
+                    table = getattr( db.root, label )
+                    expectedrows = len(table) + estimate
+                    
+                    # the old table is removed once the new one is complete
+                    table._f_rename( '%s_merged' % label )
+                    values = merge_runs( table_values( table ), values )
+                    db.removeNode( zoom_parent(db), label, recursive=True )
+                    if sigmas:
+                        db.removeNode( smooth_parent(db), label, recursive=True )
+
+                load_table( db=db, label=label, runs=values, schema=schema,
+                    filters=filters, expectedrows=expectedrows, sigmas=sigmas, step=step )
+                
+                if label + '_merged' in db.root._v_children:
+                    db.removeNode( db.root, label + '_merged' )
+                changed.append( label )
+            
+            db.close()
+            if reclaim and changed:
+                repack( self.index )
+
+            from genetrack import peaklib
+            path = peaklib.peak_path( self.index )
+            if changed and os.path.isfile( path ):
+                logger.warn('removing the outdated peaks %s, rerun the peak prediction to store new ones' % path)
+                os.remove( path )
+        finally:
+            if db.isopen:
+                db.close()
+            self.open()
+
+        return changed
+
+    def peak_data(self):
+        """
+        Returns the stored peak predictions of the index (see the `peaklib` module) 
+        or None if there are none. The peaks are reopened when the file changes.
+        """
+        from genetrack import peaklib
+        path = peaklib.peak_path( self.index )
+        if not os.path.isfile( path ):
+            return None
+        key = ( 'peaks', path, os.path.getmtime(path) )
+        
+        # the peaks are stored in an HDF file even for flat indices
+        HDF_LOCK.acquire()
+        try:
+            if key not in self.cache:
+                self.close_peaks()
+                self.cache[key] = peaklib.PeakData( path )
+            return self.cache[key]
+        finally:
+            HDF_LOCK.release()
+
+    def close_peaks(self):
+        "Closes the stored peak predictions"
+        HDF_LOCK.acquire()
+        try:
+            for key in self.cache.keys():
+                if key[0] == 'peaks':
+                    self.cache.pop( key ).close()
+        finally:
+            HDF_LOCK.release()
+
+    @locked
     def close(self):
+        self.close_peaks()
         if self.db is not None:
             self.db.close()
+            self.db = None
     
     def __del__(self):
         self.close()
 
+class IndexPool(object):
+    """
+    A thread safe pool of open, read only PositionalData instances. 
+    The same instance is shared by the threads, its methods that read 
+    the files hold the lock of the instance (see `HDF_LOCK`).
+    
+    The instances are keyed by the path, the modification time, the size 
+    and the inode of the index, thus a rebuilt index is reopened on the next access. 
+    Paths that are directories are opened as flat indices (see `flatlib`), 
+    a flat index converted next to the HDF index is preferred when it is 
+    not older than the HDF index.
+    When the pool is full the least recently used instance is dropped.
+    Dropped instances close their files once the last reference to them 
+    is released, the instances returned by the pool should not be closed 
+    explicitly.
+
+    >>> from genetrack import conf
+    >>> pool = IndexPool(size=1)
+    >>> fname = conf.testdata('test-hdflib-input.txt')
+    >>> data = pool.get(fname=fname, workdir=conf.TEMP_DATA_DIR)
+    >>> data is pool.get(fname=fname, workdir=conf.TEMP_DATA_DIR)
+    True
+    >>> data.labels
+    ['chr1', 'chr2', 'chr3']
+    """
+    def __init__(self, size=POOL_SIZE):
+        self.size  = size
+        self.lock  = threading.Lock()
+        self.store = {}
+        self.order = []
+
+    def get(self, fname, workdir=None, index=None):
+        "Returns an open PositionalData for the file, see the PositionalData for parameters"
+        from genetrack import flatlib
+        path = index_path( fname=fname, workdir=workdir, index=index )
+        if os.path.isdir(path):
+            # flat indices are directories, see the flatlib module
+            target = path
+        elif flatlib.is_current(path):
+            target = flatlib.flat_path(path)
+        elif missing(path):
+            raise Exception('No autobuild allowed and no index found at %s' % path)
+        else:
+            target = None
+        stamp = target and os.path.join(target, flatlib.HEADER) or path
+        
+        # the modification times may have a resolution of a second
+        stat = os.stat(stamp)
+        key = ( path, stamp, stat.st_mtime, stat.st_size, stat.st_ino )
+
+        self.lock.acquire()
+        try:
+            if key in self.store:
+                self.order.remove( key )
+            else:
+                # instances of rebuilt indices are outdated
+                for old in [ k for k in self.order if k[0] == path ]:
+                    self.drop( old )
+                if target:
+                    self.store[key] = flatlib.FlatData( index=target, fname=fname )
+                else:
+                    self.store[key] = PositionalData( fname=fname, workdir=workdir, index=index, nobuild=True )
+            self.order.append( key )
+            
+            while len(self.order) > self.size:
+                self.drop( self.order[0] )
+            
+            return self.store[key]
+        finally:
+            self.lock.release()
+
+    def drop(self, key):
+        "Removes an instance from the pool"
+        self.order.remove( key )
+        del self.store[key]
+
+# the process wide pool of open indices
+POOL = IndexPool()
+
 def test( verbose=0 ):
     """
     Test runner
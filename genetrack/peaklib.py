@@ -0,0 +1,140 @@
+"""
+Storage of predicted peaks.
+
+The peaks of each label are stored in a table sorted by the start
+coordinates. The tables are kept in an HDF file next to the index
+that the peaks were predicted from, see the `peak_path` function.
+"""
+import os
+import numpy
+from tables import openFile, IsDescription, IntCol, FloatCol, StringCol
+from genetrack import logger, util, hdflib
+
+class PeakSchema( IsDescription ):
+    """
+    Stores a peak as an interval with a value and a strand
+    """
+    start  = IntCol   ( pos=1 )  # start of the peak
+    end    = IntCol   ( pos=2 )  # end of the peak
+    value  = FloatCol ( pos=3 )  # the height of the peak
+    strand = StringCol( 1, pos=4 ) # the strand, + or -
+
+def peak_path( index ):
+    """
+    Returns the path to the peak file that belongs to an index
+
+    >>> peak_path( 'data/reads.txt.hdf' )
+    'data/reads.txt.peaks.hdf'
+    """
+    base, ext = os.path.splitext( index )
+    return '%s.peaks.hdf' % base
+
+class PeakData( hdflib.SortedSearch ):
+    """
+    Stores and queries peaks. The parameters that the peaks were
+    predicted with are kept as the attributes of the file.
+
+    >>> from genetrack import conf
+    >>> fname = conf.tempdata( 'test-peaklib.peaks.hdf' )
+    >>> peaks = PeakData( fname, mode='w', sigma=20, exclusion=10 )
+    >>> peaks.add( 'chr1', starts=[ 50, 10, 30 ], ends=[ 60, 20, 40 ], values=[ 3, 1, 2 ], strands=[ '+', '+', '-' ] )
+    >>> peaks.close()
+    >>> peaks = PeakData( fname )
+    >>> peaks.labels, peaks.attrs.sigma, peaks.attrs.exclusion
+    (['chr1'], 20, 10)
+    >>> results = peaks.query( 'chr1', 15, 35 )
+    >>> list( results.start ), list( results.end ), list( results.value ), list( results.strand )
+    ([10, 30], [20, 40], [1.0, 2.0], ['+', '-'])
+    >>> results = peaks.query( 'chr1', 15, 35, strand='-' )
+    >>> list( results.start )
+    [30]
+    >>> list( peaks.query( 'chr2', 0, 100 ).start )
+    []
+    >>> peaks.close()
+    """
+    # serializes the access to the HDF file, see `hdflib.locked`
+    lock = hdflib.HDF_LOCK
+
+    def __init__(self, fname, mode='r', **attrs):
+        self.fname = fname
+        self.samples = {}
+        self.cache = {}
+        self.db = openFile( fname, mode=mode, title='peak predictions' )
+        for key, value in attrs.items():
+            setattr( self.db.root._v_attrs, key, value )
+
+    @property
+    @hdflib.locked
+    def attrs(self):
+        "The parameters that the peaks were predicted with"
+        root = self.db.root._v_attrs
+        return util.Params( **dict( [ (key, getattr(root, key)) for key in root._v_attrnamesuser ] ) )
+
+    @property
+    @hdflib.locked
+    def labels(self):
+        "Labels in the file"
+        labs = [ x.name for x in self.db.root._f_listNodes(classname='Table') ]
+        util.nice_sort( labs )
+        return labs
+
+    def table(self, label):
+        key = ('table', label)
+        if key not in self.cache:
+            self.cache[key] = getattr( self.db.root, label )
+        return self.cache[key]
+
+    @hdflib.locked
+    def add(self, label, starts, ends, values, strands):
+        "Stores the peaks of a label, the peaks are sorted by their starts"
+        starts = numpy.asarray( starts )
+        order  = starts.argsort( kind='mergesort' )
+        table  = self.db.createTable( "/", label, PeakSchema, 'peaks on %s' % label, expectedrows=max(len(starts), 1) )
+        rows   = numpy.zeros( len(starts), dtype=table.dtype )
+        rows['start']  = starts.take( order )
+        rows['end']    = numpy.asarray( ends ).take( order )
+        rows['value']  = numpy.asarray( values ).take( order )
+        rows['strand'] = numpy.asarray( strands ).take( order )
+        table.append( rows )
+        table.attrs.width = len(rows) and int( (rows['end'] - rows['start']).max() ) or 0
+        table.flush()
+        logger.info('stored %s peaks on %s' % (util.commify(len(rows)), label))
+
+    @hdflib.locked
+    def query(self, label, start, end, strand=None):
+        """
+        Returns the peaks that overlap the interval from start to end
+        as a class with attributes for start, end, value and strand.
+        """
+        if label not in self.db.root._v_children:
+            return util.Params( start=numpy.zeros(0, int), end=numpy.zeros(0, int), 
+                value=numpy.zeros(0), strand=numpy.zeros(0, 'S1') )
+
+        # the peaks are sorted by start, the longest one tells 
+        # how far back an overlapping peak may start
+        table  = self.table( label )
+        istart = self.search( table, start - table.attrs.width, colattr='start' )
+        iend   = self.search( table, end, colattr='start' )
+        data   = table.read( istart, iend )
+
+        keep = data['end'] > start
+        if strand:
+            keep &= data['strand'] == strand
+        data = data[keep]
+        return util.Params( start=data['start'], end=data['end'], value=data['value'], strand=data['strand'] )
+
+    @hdflib.locked
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+def test( verbose=0 ):
+    """
+    Test runner
+    """
+    import doctest
+    doctest.testmod(optionflags=doctest.ELLIPSIS)
+
+if __name__ == "__main__":
+    test()
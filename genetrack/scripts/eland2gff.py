@@ -22,7 +22,7 @@ Run the script with no parameters to see the options that it takes.
 """
 import os, sys, csv
 from itertools import *
-from genetrack import logger, conf, util
+from genetrack import logger, conf, util, gziplib
 
 
 def transform(inpname, size, outname=None):
@@ -33,7 +33,8 @@ def transform(inpname, size, outname=None):
     logger.debug('input %s' % inpname)
     logger.debug('output %s' % outname)
 
-    reader = csv.reader(open(inpname), delimiter='\t')
+    # compressed inputs are decompressed while being read
+    reader = csv.reader(gziplib.open_input(inpname, 'rU'), delimiter='\t')
 
     # unwind the iterator 
     list(takewhile( lambda x: x[0].startswith('#'), reader))
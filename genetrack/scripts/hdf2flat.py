@@ -0,0 +1,73 @@
+"""
+Converts a genetrack HDF index into the flat binary format
+(see `genetrack.flatlib`) that is read via memory maps. 
+
+The program may be invoked in multiple ways. As a standalone script::
+
+    python hdf2flat.py
+
+As a python module::
+
+    python -m genetrack.scripts.hdf2flat
+
+Or in other python scripts::
+
+>>>
+>>> from genetrack.scripts import hdf2flat
+>>> hdf2flat.transform(inpname, outname)
+>>>
+
+Run the script with no parameters to see the options that it takes.
+
+"""
+import os, sys
+from genetrack import logger, conf, util, flatlib
+
+def transform(inpname, outname=None):
+    """
+    Converts the HDF index into a flat index
+    """
+    outname = outname or flatlib.flat_path( inpname )
+    timer = util.Timer()
+    flatlib.convert(inpname=inpname, outname=outname)
+    logger.info("conversion finished in %s" % timer.report())
+    return outname
+
+if __name__ == '__main__':
+    import optparse
+
+    usage = "usage: %prog -i inputfile -o outputdir"
+
+    parser = optparse.OptionParser(usage=usage)
+
+    # setting the input file name
+    parser.add_option(
+        '-i', '--input', action="store", 
+        dest="inpname", type='str', default=None,
+        help="the input hdf file name (required)"
+    )
+
+    # setting the output directory
+    parser.add_option(
+        '-o', '--output', action="store", 
+        dest="outname", type='str', default=None,
+        help="the output directory (default=input name with .flat extension)"
+    )
+
+    # verbosity can be 0,1 and 2 (increasing verbosity)
+    parser.add_option(
+        '-v', '--verbosity', action="store", 
+        dest="verbosity", type="int", default=1, 
+        help="sets the verbosity (0, 1) (default=1)",
+    )
+
+    options, args = parser.parse_args()
+
+    # set verbosity
+    logger.disable( options.verbosity )
+
+    # missing input file name
+    if not options.inpname:
+        parser.print_help()
+    else:
+        transform(inpname=options.inpname, outname=options.outname)
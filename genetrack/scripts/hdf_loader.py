@@ -18,18 +18,29 @@ Or in other python scripts::
 
 Run the script with no parameters to see the options that it takes.
 
-**Observed runtime**: insertion rate of 6 million lines per minute
+**Observed runtime**: insertion rate of 30 million lines per minute
 
 """
 import os, sys, csv
 from genetrack import logger, conf, util, hdflib
 
 
-def transform(inpname, workdir=None, update=False):
+def transform(inpname, workdir=None, update=False, complib=None, complevel=5, compact=False, workers=1, sigmas=(), step=1):
     """
     Creates a transform from a genetrack input file
     """
-    index = hdflib.PositionalData(fname=inpname, workdir=workdir, update=update)        
+    index = hdflib.PositionalData(fname=inpname, workdir=workdir, update=update, 
+        complib=complib, complevel=complevel, compact=compact, workers=workers, 
+        sigmas=sigmas, step=step)
+    return index
+
+def merge(inpname, mergename, workdir=None):
+    """
+    Merges a second genetrack input file into the index of the first one
+    """
+    index = hdflib.PositionalData(fname=inpname, workdir=workdir, nobuild=True)
+    labels = index.merge(mergename)
+    logger.info('merged labels: %s' % ', '.join(labels))
     return index
 
 if __name__ == '__main__':
@@ -64,6 +75,47 @@ if __name__ == '__main__':
         action="store_true", dest="update", default=False,
         help="recreates the index even if it exists")
 
+    # compression of the index
+    parser.add_option(
+        '--complib', action="store", 
+        dest="complib", type='str', default=None,
+        help="compression library: zlib, lzo, bzip2 or blosc (default=no compression)"
+    )
+
+    parser.add_option(
+        '--complevel', action="store", 
+        dest="complevel", type='int', default=5,
+        help="compression level 1-9 (default=5)"
+    )
+
+    parser.add_option("--compact",
+        action="store_true", dest="compact", default=False,
+        help="stores the data as 32 bit integers and floats")
+
+    parser.add_option(
+        '-m', '--merge', action="store", 
+        dest="merge", type='str', default=None,
+        help="merges this genetrack input file into the existing index, the index is repacked afterwards"
+    )
+
+    parser.add_option(
+        '--workers', action="store", 
+        dest="workers", type='int', default=1,
+        help="number of processes that build the chromosomes in parallel (default=1)"
+    )
+
+    parser.add_option(
+        '--sigmas', action="store", 
+        dest="sigmas", type='str', default='',
+        help="comma separated sigmas of the smoothed tables stored in the index (default=none)"
+    )
+
+    parser.add_option(
+        '--step', action="store", 
+        dest="step", type='int', default=1,
+        help="stores every step-th position of the smoothed tables (default=1)"
+    )
+
     options, args = parser.parse_args()
 
     # set verbosity
@@ -72,5 +124,10 @@ if __name__ == '__main__':
     # missing input file name
     if not options.inpname:
         parser.print_help()
+    elif options.merge:
+        merge(inpname=options.inpname, mergename=options.merge, workdir=options.workdir)
     else:
-        transform(inpname=options.inpname, workdir=options.workdir, update=options.update)
+        transform(inpname=options.inpname, workdir=options.workdir, update=options.update,
+            complib=options.complib, complevel=options.complevel, compact=options.compact,
+            workers=options.workers, sigmas=map(float, filter(None, options.sigmas.split(','))), 
+            step=options.step)
@@ -22,10 +22,15 @@ Run the script with no parameters to see the options that it takes.
 
 """
 import os, sys, csv
-from genetrack import logger, util, hdflib, fitlib
+import numpy
+from itertools import chain, izip
+from genetrack import logger, util, hdflib, fitlib, peaklib
 
 TWOSTRAND = "two"
 
+# this many pending peaks without a gap force a selection
+PENDING_LIMIT = 10**5
+
 commify = util.commify
 
 def output(stream, peaks, chrom, w=73, strand='+', ):
@@ -36,6 +41,155 @@ def output(stream, peaks, chrom, w=73, strand='+', ):
         start, end = mid - w, mid + w
         stream.write("%s\t%d\t%d\t.\t%f\t%s\n" % (chrom, start, end, value, strand))
 
+def detected_peaks(segments):
+    """
+    Detects the local maxima over a stream of smoothed segments. The last
+    two values of each segment are carried over so that every value 
+    is checked exactly once. Yields a list of peaks for each segment.
+    """
+    last_x, last_y = numpy.zeros(0, numpy.int), numpy.zeros(0)
+    for fx, fy in segments:
+        fx = numpy.concatenate( (last_x, fx) )
+        fy = numpy.concatenate( (last_y, fy) )
+        yield fitlib.detect_peaks( x=fx, y=fy )
+        last_x, last_y = fx[-2:], fy[-2:]
+
+def selected_peaks(peak_lists, exclusion, threshold, limit=PENDING_LIMIT):
+    """
+    Selects the maximal non-overlapping peaks from a stream of peak lists.
+    
+    Peaks that are farther apart than the exclusion zone cannot block each other
+    thus the selection is final up to the last such gap and the peaks after 
+    it are kept pending until the next list arrives. The result is identical 
+    to selecting from all peaks at once. 
+    
+    When more than limit peaks are pending without a gap only the peaks 
+    within the exclusion zone of the last peak are kept pending and the 
+    peaks that were already selected take precedence at this seam.
+
+    Yields the selected peaks for each list and once more at the end.
+    """
+    pending, last = [], None
+    for peaks in chain( peak_lists, [ None ] ):
+        final = peaks is None
+        if not final:
+            pending.extend( peaks )
+        
+        # drop the peaks blocked by the last selected peak
+        if last is not None:
+            pending = [ (x, y) for x, y in pending if x >= last + exclusion ]
+        
+        xs = numpy.array( [ x for x, y in pending ], numpy.int )
+        gaps = ( numpy.diff( xs ) > exclusion ).nonzero()[0]
+        
+        if final:
+            done, pending = fitlib.select_peaks( peaks=pending, exclusion=exclusion, threshold=threshold ), []
+        elif len(gaps):
+            # the peaks before the gap are independent of the upcoming peaks
+            cut = gaps[-1] + 1
+            done, pending = fitlib.select_peaks( peaks=pending[:cut], exclusion=exclusion, threshold=threshold ), pending[cut:]
+        elif len(pending) > limit:
+            # the peaks after the horizon may still be blocked by upcoming peaks
+            horizon  = xs[-1] - exclusion
+            selected = fitlib.select_peaks( peaks=pending, exclusion=exclusion, threshold=threshold )
+            done     = [ (x, y) for x, y in selected if x < horizon ]
+            pending  = pending[ xs.searchsorted( horizon ): ]
+        else:
+            done = []
+        
+        if done:
+            last = done[-1][0]
+        yield done
+
+def stored_segments(index, label, field, options):
+    """
+    Yields the segments of the precomputed smoothed table of a label 
+    with the values of the field over the level.
+    """
+    table = index.smooth_table( label, options.sigma )
+    for start in xrange(0, len(table), options.maxsize):
+        data = table.read( start, start + options.maxsize )
+        x, y = data['idx'], data[field]
+        keep = y > options.level
+        yield x[keep], y[keep]
+
+def method_kernel( method ):
+    """
+    Returns the kernel code of a smoothing method
+
+    >>> method_kernel( 'gauss' ), method_kernel( 'uniform' )
+    ('GK', 'UK')
+    """
+    for kernel, name in fitlib.KERNEL_METHODS.items():
+        if name == method:
+            return kernel
+    raise Exception( 'invalid smoothing method %s' % method )
+
+def predict_peaks(index, label, field, options):
+    """
+    Streams the data of a label from the index and yields lists of 
+    peaks predicted on the values of a field. The smoothed values 
+    are read from the index when it stores them for the sigma 
+    at every position, these are identical to smoothing on the fly.
+    """
+    kernel = method_kernel( options.method )
+    levels = dict( index.smooth_levels( label ) )
+    if kernel == 'GK' and levels.get( options.sigma ) == 1 and options.level >= hdflib.SMOOTH_EPSILON:
+        logger.debug('reading the smoothed values of %s' % label)
+        segments = stored_segments( index, label, field, options )
+    else:
+        chunks = index.chunks( label, size=options.maxsize, fields=('idx', field), aslist=False )
+        segments = fitlib.smoothed_segments( chunks, sigma=options.sigma, epsilon=options.level, kernel=kernel )
+    peaks = detected_peaks( segments )
+    if options.mode != 'all':
+        peaks = selected_peaks( peaks, exclusion=options.exclude, threshold=options.level )
+    return peaks
+
+def predict_worker(params):
+    """
+    Predicts the peaks of one label on one field,
+    runs in the worker processes of a parallel prediction.
+    """
+    path, label, field, options = params
+    index = hdflib.PositionalData(fname='', index=path, nobuild=True)
+    try:
+        results = list( predict_peaks(index, label, field, options) )
+    finally:
+        index.close()
+    return results
+
+def serial_streams(index, strands, options):
+    "Yields each label with the streams of peaks for each strand"
+    for label in index.labels:
+        table = index.table(label)
+        info  = util.commify(len(table))
+        logger.info('predicting on %s with %s measurements' % (label, info))
+        yield label, [ predict_peaks(index, label, field, options) for field, strand in strands ]
+
+def parallel_streams(index, strands, options):
+    """
+    Yields each label with the peaks for each strand. Each label and strand 
+    is predicted in a pool of worker processes, the results are 
+    returned in the original order.
+    """
+    import multiprocessing
+    
+    # the workers open their own file handles, an open 
+    # handle must not be shared with the forked processes
+    path, labels = index.index, index.labels
+    index.close()
+
+    tasks = [ (path, label, field, options) for label in labels for field, strand in strands ]
+    logger.info('predicting %s tasks with %s workers' % (len(tasks), options.workers))
+    pool = multiprocessing.Pool( options.workers )
+    try:
+        results = pool.imap( predict_worker, tasks )
+        for label in labels:
+            logger.info('collecting %s' % label)
+            yield label, [ results.next() for strand in strands ]
+    finally:
+        pool.terminate()
+
 def predict(inpname, outname, options):
     """
     Generate the peak predictions on a genome wide scale
@@ -50,51 +204,49 @@ def predict(inpname, outname, options):
 
     fp = file(outname, 'wt')
 
-    for label in index.labels:
-        table = index.table(label)
-        size  = table.cols.idx[-1]
-        info  = util.commify(size)
-        logger.info('predicting on %s of total size %s' % (label, info))
-        lo = 0
-        hi = min( (size, options.maxsize) )
-
-        while True:
-            if lo >= size:
-                break
-            perc = '%.1f%%' % (100.0*lo/size)
-            logger.info('processing %s %s:%s (%s)' % (label, lo, hi, perc))
-            
-            # get the data
-            res = index.query(start=lo, end=hi, label=label)
-
-            
-            # exclusion zone
-            w = options.exclude/2
-
-            def predict(x, y):
-                fx, fy = fitlib.gaussian_smoothing(x=x, y=y, sigma=options.sigma, epsilon=options.level )
-                peaks = fitlib.detect_peaks(x=fx, y=fy )
-                if options.mode != 'all':
-                    peaks = fitlib.select_peaks(peaks=peaks, exclusion=options.exclude, threshold=options.level)
-                return peaks
-
-            if options.strand == TWOSTRAND:
-                # operates in two strand mode
-                for yval, strand in [ (res.fwd, '+'), (res.rev, '-') ]:
-                    logger.debug('processing strand %s' % strand)
-                    peaks = predict(x=res.idx, y=yval)
-                    output(stream=fp, peaks=peaks, chrom=label, w=w, strand=strand)
-            else:
-                # combine strands
-                peaks = predict(x=res.idx, y=res.val)
-                output(stream=fp, peaks=peaks, chrom=label, w=w, strand='+')
-
-            # switching to a higher interval
-            lo = hi
-            hi += options.maxsize
+    # exclusion zone
+    w = options.exclude/2
+
+    if options.strand == TWOSTRAND:
+        # operates in two strand mode
+        strands = [ ('fwd', '+'), ('rev', '-') ]
+    else:
+        # combine strands
+        strands = [ ('val', '+') ]
+
+    # the peaks may be stored next to the index, see the peaklib module
+    store = None
+    if options.store:
+        path  = peaklib.peak_path( index.index )
+        store = peaklib.PeakData( path + '.tmp', mode='w', sigma=options.sigma, exclusion=options.exclude, 
+            level=options.level, predictor=options.mode, strand=options.strand, method=options.method )
+
+    if options.workers > 1:
+        labels = parallel_streams(index, strands, options)
+    else:
+        labels = serial_streams(index, strands, options)
+
+    for label, streams in labels:
+        collect = []
+        # the strands are written side by side, one chunk at a time
+        for results in izip( *streams ):
+            for peaks, (field, strand) in zip( results, strands ):
+                output(stream=fp, peaks=peaks, chrom=label, w=w, strand=strand)
+                if store is not None:
+                    collect.extend( [ (mid, value, strand) for mid, value in peaks ] )
+
+        if store is not None:
+            mids = numpy.array( [ mid for mid, value, strand in collect ], numpy.int )
+            store.add( label, starts=mids - w, ends=mids + w, 
+                values=[ value for mid, value, strand in collect ], strands=[ strand for mid, value, strand in collect ] )
         
     fp.close()
 
+    # the complete file replaces the previous peaks
+    if store is not None:
+        store.close()
+        os.rename( store.fname, path )
+
 def option_parser():
     "The option parser may be constructed in other tools invoking this script"
     import optparse
@@ -131,6 +283,13 @@ def option_parser():
         help="the smoothing factor",
     )
 
+    # the smoothing kernel
+    parser.add_option(
+        '--method', action="store", 
+        dest="method", type="choice", default="gauss", choices=sorted( fitlib.KERNEL_METHODS.values() ),
+        help="the smoothing kernel: 'gauss', 'triangle', 'epanechnikov' or 'uniform'",
+    )
+
     # the exclusion zone
     parser.add_option(
         '--exclusion', action="store", 
@@ -161,8 +320,20 @@ def option_parser():
 
     parser.add_option(
         '--maxsize', action="store", 
-        dest="maxsize", type="int", default=10**7, 
-        help="the size of the largest internal array allocated (default=10 million)",
+        dest="maxsize", type="int", default=10**6, 
+        help="the number of measurements processed at a time (default=1 million)",
+    )
+
+    parser.add_option(
+        '--workers', action="store", 
+        dest="workers", type="int", default=1, 
+        help="the number of processes that predict the labels and strands (default=1)",
+    )
+
+    parser.add_option(
+        '--store', action="store_true", 
+        dest="store", default=False, 
+        help="stores the peaks next to the index for the browser",
     )
 
     parser.add_option(
@@ -25,59 +25,526 @@ Run the script with no parameters to see the options that it takes.
 A genetrack input file format is a tab delimited text file
 described in the API documentation of the PositionalData 
 class: `genetrack.hdflib.PositionalData`
-The transformation is a three step process, *transform*, 
-*sort* and *consolidate*. It will create files in the 
-genetrack temporary data directory and it will remove the intermediate files 
-when the process is complete.
+The transformation is a three step process, *parse*, 
+*aggregate* and *write*. Inputs that fit into the memory limit are 
+aggregated in memory with bincounts over the positions, larger 
+inputs are sorted. The parsed reads are sorted in memory in runs
+of fixed size, the runs are spilled into a binary file in the 
+genetrack temporary data directory then merged by chromosome while 
+the reads at identical positions are summed. The temporary 
+file is removed when the process is complete.
+
+The input may be gzip or bgzip compressed, see `genetrack.gziplib`.
+
+With the index option the merged reads are loaded directly into
+the HDF index that is written to the output file, the genetrack 
+input file is written only when requested with the gtrack option.
+The index takes the same build options as the hdf_loader script.
 
 **Observed runtime**: tranformation rate of 2 million lines per minute
 
-**Note1**: The script will invoke the system `sort` command to sort the file 
-that is substantially faster under Unix than Windows.
-
 """
-import os, sys, csv, shutil
+import os, sys, csv, re
+import numpy
 from itertools import *
-from genetrack import logger, conf, util, hdflib
+from genetrack import logger, conf, util, hdflib, gziplib
+
+# the number of reads sorted in memory at a time
+RUN_SIZE = 10**6
+
+# the reads are aggregated in memory when their estimated 
+# footprint is under this many megabytes, otherwise these are sorted in runs 
+MEMORY_LIMIT = 1024
+
+# the estimated bytes used by a read when aggregating in memory
+READ_BYTES = 64
+
+# the positions of a chromosome are counted over their span while it 
+# is at most this many times the number of reads, otherwise via numpy.unique
+DENSE_SPAN = 64
+
+# the bytes used by each position of the span when counting over it
+DENSE_BYTES = 5
+
+# the size of the byte ranges parsed by the worker processes
+RANGE_SIZE = 2**25
+
+# at most this many ranges per worker process are parsed or buffered at a time
+RANGE_WINDOW = 4
+
+# the lines that start or continue the sequences that may follow the features of a gff file
+SEQUENCE = re.compile( r'^(>|##FASTA|[A-Za-z*-]+\r?$)', re.M )
+
+# the strand codes of the parsed reads
+FORWARD, REVERSE, NOSTRAND = 0, 1, 2
 
-def consolidate( inpname, outname, format):
+# the records of the sorted runs, the positions with the read counts
+RECORD = numpy.dtype( [ ('idx', '<i8'), ('fwd', '<i4'), ('rev', '<i4'), ('val', '<i4') ] )
+
+def aggregate( records ):
     """
-    Consolidates an input file. 
-    Merges multiple indentical indices into one line
+    Sums the counts of the records at identical positions,
+    the records must be sorted by position.
+
+    >>> records = numpy.array( [ (1, 1, 0, 1), (1, 0, 1, 1), (5, 1, 0, 1) ], dtype=RECORD )
+    >>> aggregate( records ).tolist()
+    [(1, 1, 1, 2), (5, 1, 0, 1)]
     """
-    fp = open(outname, 'wt')
+    if not len(records):
+        return records
+    idx = records['idx']
+    starts = numpy.flatnonzero( idx[1:] != idx[:-1] ) + 1
+    starts = numpy.concatenate( ( [0], starts ) )
+    result = numpy.zeros( len(starts), dtype=RECORD )
+    result['idx'] = idx.take( starts )
+    for name in ( 'fwd', 'rev', 'val' ):
+        result[name] = numpy.add.reduceat( records[name], starts )
+    return result
+
+def count_records( idx, strand ):
+    """
+    Turns the positions and strand codes of reads into aggregated records
 
-    # recover the original basename
-    basename = os.path.basename(inpname).replace('.sorted', '')
+    >>> count_records( numpy.array( [ 7, 3, 7 ] ), numpy.array( [ FORWARD, NOSTRAND, REVERSE ] ) ).tolist()
+    [(3, 0, 0, 1), (7, 1, 1, 2)]
+    """
+    order = idx.argsort( kind='mergesort' )
+    strand = strand.take( order )
+    records = numpy.zeros( len(idx), dtype=RECORD )
+    records['idx'] = idx.take( order )
+    records['fwd'] = strand == FORWARD
+    records['rev'] = strand == REVERSE
+    records['val'] = 1
+    return aggregate( records )
+
+def count_positions( idx, strand, limit=MEMORY_LIMIT ):
+    """
+    Turns the positions and strand codes of reads into aggregated 
+    records without sorting the reads. The occupied positions are 
+    marked over the span of the reads and are numbered in order, 
+    the reads are counted by these numbers. Spans that are sparse 
+    (see DENSE_SPAN) or do not fit into limit megabytes are 
+    numbered via numpy.unique.
+
+    >>> count_positions( numpy.array( [ 7, 3, 7 ] ), numpy.array( [ FORWARD, NOSTRAND, REVERSE ] ) ).tolist()
+    [(3, 0, 0, 1), (7, 1, 1, 2)]
+    >>> count_positions( numpy.array( [ 10**6, 3, 3 ] ), numpy.array( [ FORWARD, REVERSE, REVERSE ] ) ).tolist()
+    [(3, 0, 2, 2), (1000000, 1, 0, 1)]
+    """
+    if not len(idx):
+        return numpy.zeros( 0, dtype=RECORD )
+    
+    # each read gets the number of its position
+    lo, hi = idx.min(), idx.max()
+    span = hi - lo + 1
+    if span <= DENSE_SPAN * len(idx) and span * DENSE_BYTES <= limit * 2**20:
+        offsets  = idx - lo
+        occupied = numpy.zeros( span, bool )
+        occupied[offsets] = True
+        positions = occupied.nonzero()[0]
+        rank = numpy.empty( span, numpy.int32 )
+        rank[positions] = numpy.arange( len(positions), dtype=numpy.int32 )
+        positions, codes = positions + lo, rank.take( offsets )
+    else:
+        positions, codes = numpy.unique( idx, return_inverse=True )
+    
+    size = len(positions)
+    records = numpy.zeros( size, dtype=RECORD )
+    records['idx'] = positions
+    records['val'] = numpy.bincount( codes, minlength=size )
+    records['fwd'] = numpy.bincount( codes[strand == FORWARD], minlength=size )
+    records['rev'] = numpy.bincount( codes[strand == REVERSE], minlength=size )
+    return records
+
+class ReadCounter(object):
+    """
+    Aggregates the reads in memory, has the same interface 
+    as the ReadSorter. Used for inputs that fit into memory. 
+
+    >>> counter = ReadCounter()
+    >>> counter.add( 'chr1', numpy.array( [ 5, 1 ] ), numpy.array( [ FORWARD, FORWARD ] ) )
+    >>> counter.add( 'chr1', numpy.array( [ 5 ] ), numpy.array( [ REVERSE ] ) )
+    >>> [ block.tolist() for block in counter.merge( 'chr1' ) ]
+    [[(1, 1, 0, 1), (5, 1, 1, 2)]]
+    >>> counter.close()
+    """
+    def __init__(self, limit=MEMORY_LIMIT):
+        self.limit = limit
+        self.buffer = {}
+
+    @property
+    def labels(self):
+        "The chromosomes of the reads"
+        return sorted( self.buffer )
+
+    def add(self, label, idx, strand):
+        "Adds the positions and strand codes of the reads on a chromosome"
+        self.buffer.setdefault( label, [] ).append( (idx, strand) )
+
+    def rows(self, label):
+        "The number of reads on a chromosome, an upper limit for the positions"
+        return sum( [ len(idx) for idx, strand in self.buffer.get( label, [] ) ] )
+
+    def merge(self, label, size=None):
+        "Yields the records of a chromosome in a single block"
+        parts = self.buffer.get( label, [] )
+        if parts:
+            idx = numpy.concatenate( [ part[0] for part in parts ] )
+            strand = numpy.concatenate( [ part[1] for part in parts ] )
+            yield count_positions( idx, strand, limit=self.limit )
+
+    def close(self):
+        self.buffer = {}
+
+class ReadSorter(object):
+    """
+    An external sort for reads that may not fit into memory. The reads
+    are buffered until the run size is reached, then each chromosome of 
+    the run is sorted, aggregated and spilled into a binary file. 
+    The runs of a chromosome are merged in blocks.
+
+    >>> from genetrack import conf
+    >>> sorter = ReadSorter( conf.tempdata( 'test-tabs2genetrack.runs' ), size=2 )
+    >>> sorter.add( 'chr2', numpy.array( [ 5, 1 ] ), numpy.array( [ FORWARD, FORWARD ] ) )
+    >>> sorter.add( 'chr1', numpy.array( [ 3 ] ), numpy.array( [ REVERSE ] ) )
+    >>> sorter.add( 'chr2', numpy.array( [ 5, 2 ] ), numpy.array( [ REVERSE, NOSTRAND ] ) )
+    >>> sorter.labels
+    ['chr1', 'chr2']
+    >>> [ block.tolist() for block in sorter.merge( 'chr2', size=2 ) ]
+    [[(1, 1, 0, 1)], [(2, 0, 0, 1)], [(5, 1, 1, 2)]]
+    >>> sorter.close()
+    """
+    def __init__(self, fname, size=RUN_SIZE):
+        self.fname = fname
+        self.size = size
+        self.fp = file( fname, 'w+b' )
+        self.runs = {}
+        self.buffer = {}
+        self.count = 0
+
+    @property
+    def labels(self):
+        "The chromosomes of the reads"
+        labels = set( self.runs ) | set( self.buffer )
+        return sorted( labels )
+
+    def add(self, label, idx, strand):
+        "Adds the positions and strand codes of the reads on a chromosome"
+        self.buffer.setdefault( label, [] ).append( (idx, strand) )
+        self.count += len(idx)
+        if self.count >= self.size:
+            self.spill()
+
+    def rows(self, label):
+        "An upper limit for the number of positions on a chromosome"
+        stored = sum( [ count for offset, count in self.runs.get( label, [] ) ] )
+        return stored + sum( [ len(idx) for idx, strand in self.buffer.get( label, [] ) ] )
+
+    def spill(self):
+        "Sorts the buffered reads and writes them into the file"
+        self.fp.seek( 0, 2 )
+        for label, parts in self.buffer.items():
+            idx = numpy.concatenate( [ part[0] for part in parts ] )
+            strand = numpy.concatenate( [ part[1] for part in parts ] )
+            records = count_records( idx, strand )
+            self.runs.setdefault( label, [] ).append( (self.fp.tell(), len(records)) )
+            records.tofile( self.fp )
+        self.buffer = {}
+        self.count = 0
+
+    def read(self, offset, start, count):
+        "Reads count records of a run starting at the start-th record"
+        self.fp.seek( offset + start * RECORD.itemsize )
+        return numpy.fromfile( self.fp, dtype=RECORD, count=count )
+
+    def merge(self, label, size=RUN_SIZE):
+        """
+        Merges the runs of a chromosome, yields blocks of records sorted by
+        position. The counts are summed over identical positions.
+        """
+        self.spill()
+        runs = self.runs.get( label, [] )
+        step = max( size / max(len(runs), 1), 1 )
+        blocks = [ numpy.zeros(0, dtype=RECORD) ] * len(runs)
+        starts = [ 0 ] * len(runs)
+        while True:
+            # refill the exhausted blocks
+            for pos, (offset, count) in enumerate( runs ):
+                if not len(blocks[pos]) and starts[pos] < count:
+                    blocks[pos] = self.read( offset, starts[pos], min(step, count - starts[pos]) )
+                    starts[pos] += len(blocks[pos])
+            
+            if not sum( map(len, blocks) ):
+                break
+
+            # the runs are aggregated thus the positions up to the 
+            # smallest last position of the partially read runs are complete
+            lasts = [ block['idx'][-1] for block, start, (offset, count) in zip(blocks, starts, runs) if start < count ]
+            if lasts:
+                bound = min( lasts )
+            else:
+                bound = max( [ block['idx'][-1] for block in blocks if len(block) ] )
+
+            parts = []
+            for pos, block in enumerate( blocks ):
+                index = block['idx'].searchsorted( bound, side='right' )
+                parts.append( block[:index] )
+                blocks[pos] = block[index:]
+            
+            records = numpy.concatenate( parts )
+            records = records.take( records['idx'].argsort( kind='mergesort' ) )
+            yield aggregate( records )
+
+    def close(self):
+        logger.debug("removing temporary file '%s'" % self.fname )
+        self.fp.close()
+        os.remove( self.fname )
+
+def parse( reader, columns, shift, size=RUN_SIZE ):
+    """
+    Parses the rows of a bed or gff file, yields the chromosome, the 5' end
+    positions and the strand codes of the reads, at most size reads at a time
+    """
+    CHROM, START, END, STRAND = columns
+    # the chromosomes are numbered in the order of appearance
+    names, chroms, idxs, strands = {}, [], [], []
+    for linec, row in enumerate(reader):
+        try:
+            chrom, start, end, strand = row[CHROM], row[START], row[END], row[STRAND]
+        except Exception, exc:
+            first = row[0][0]
+            # may be hitting the end of the file with other comments
+            if  first == '>':
+                break # hit the sequence content of the gff file
+            elif first == '#':
+                continue # hit upon some comments
+            else:
+                logger.error(row)
+                raise Exception(exc) 
+
+        if strand == '+':
+            # on forward strand, 5' is at start
+            idx, code = int(start) + shift, FORWARD
+        elif strand == '-':
+            # on reverse strand, 5' is at end
+            idx, code = int(end) - shift, REVERSE
+        else:
+            # no strand specified, generate interval centers
+            idx, code = (int(start)+int(end))/2, NOSTRAND
+
+        chroms.append( names.setdefault( chrom, len(names) ) )
+        idxs.append( idx )
+        strands.append( code )
+        
+        if len(idxs) == size:
+            for item in split( names, chroms, idxs, strands ):
+                yield item
+            chroms, idxs, strands = [], [], []
+
+    for item in split( names, chroms, idxs, strands ):
+        yield item
+
+def split( names, chroms, idxs, strands ):
+    """
+    Groups the parsed reads by chromosome, yields the chromosome, 
+    the positions and the strand codes of each group. The chromosomes
+    are numbered by the names dictionary, the reads keep their order 
+    within the groups.
+
+    >>> names = { 'chr2': 0, 'chr1': 1 }
+    >>> [ (chrom, idx.tolist()) for chrom, idx, strand in split( names, [ 0, 1, 0 ], [ 9, 4, 1 ], [ 0, 0, 1 ] ) ]
+    [('chr1', [4]), ('chr2', [9, 1])]
+    """
+    if not idxs:
+        return
+    # the numbers follow the order of the names
+    labels = sorted( names )
+    ranks  = numpy.zeros( len(names), numpy.int32 )
+    ranks[ [ names[label] for label in labels ] ] = numpy.arange( len(labels) )
+    codes  = ranks.take( chroms )
+    idxs, strands = numpy.array( idxs, numpy.int64 ), numpy.array( strands, numpy.int8 )
+
+    # the chromosomes are contiguous after a stable grouping, 
+    # the positions are sorted once when the runs are written
+    order = codes.argsort( kind='mergesort' )
+    codes, idxs, strands = codes.take( order ), idxs.take( order ), strands.take( order )
+    bounds = numpy.flatnonzero( codes[1:] != codes[:-1] ) + 1
+    bounds = [ 0 ] + bounds.tolist() + [ len(codes) ]
+    for start, end in zip( bounds, bounds[1:] ):
+        yield labels[codes[start]], idxs[start:end], strands[start:end]
+
+def data_range( fname ):
+    """
+    Returns the byte offsets where the reads of a file start and end.
+    Skips the track line and the comments at the start of the file,
+    the sequences that may follow the features of a gff file are 
+    found by the workers, see `parse_worker`.
+
+    >>> from genetrack import conf
+    >>> fname = conf.testdata('short-data.bed')
+    >>> data_range( fname ) == ( 0, os.path.getsize(fname) )
+    True
+    """
+    fp = file(fname, 'rb')
+    start = 0
+    line = fp.readline()
+    while line.startswith('track') or line.startswith('#'):
+        start = fp.tell()
+        line = fp.readline()
+    
+    fp.close()
+    return start, os.path.getsize(fname)
+
+def byte_ranges( fname, start, end, count ):
+    """
+    Splits the bytes from start to end into at most count 
+    ranges that begin and end at line boundaries
+
+    >>> from genetrack import conf
+    >>> fname = conf.testdata('short-data.bed')
+    >>> ranges = byte_ranges( fname, 0, os.path.getsize(fname), 3 )
+    >>> len(ranges), ranges[0][0] == 0, ranges[-1][1] == os.path.getsize(fname)
+    (3, True, True)
+    >>> fp = file(fname, 'rb')
+    >>> fp.seek( ranges[1][0] - 1 )
+    >>> fp.read(1)
+    '\\n'
+    >>> fp.close()
+    """
+    fp = file(fname, 'rb')
+    marks = [ start ]
+    for part in range( 1, count ):
+        fp.seek( start + (end - start) * part / count - 1 )
+        fp.readline()
+        marks.append( min( max( fp.tell(), marks[-1] ), end ) )
+    marks.append( end )
+    fp.close()
+    return [ (lo, hi) for lo, hi in zip( marks, marks[1:] ) if lo < hi ]
+
+def sequence_start( text ):
+    """
+    Returns the offset of the first line of a text that belongs to the 
+    sequences of a gff file, None when there are no such lines. 
+    A range may start within the sequences thus the lines 
+    of sequence letters also mark the end of the features.
+
+    >>> sequence_start( 'chr1\\t1\\t2\\n##FASTA\\n>seq\\nACGT\\n' )
+    9
+    >>> sequence_start( 'ACGT\\nACGT\\n' ), sequence_start( 'chr1\\t1\\t2\\n# comment\\n' )
+    (0, None)
+    """
+    match = SEQUENCE.search( text )
+    if match is None:
+        return None
+    return match.start()
+
+def parse_worker( params ):
+    """
+    Parses a byte range of a file, runs in the worker processes 
+    of a parallel transformation. Returns a list of (chrom, idx, strand) 
+    tuples, one tuple per chromosome, and a flag that is True when the 
+    range reaches the sequences of a gff file, the sequence lines 
+    are the end of the data.
+    """
+    fname, start, end, columns, shift = params
+    fp = file(fname, 'rb')
+    fp.seek( start )
+    text = fp.read( end - start )
+    fp.close()
+
+    cut = sequence_start( text )
+    if cut is not None:
+        text = text[:cut]
+
+    parts = {}
+    reader = csv.reader( text.splitlines(), delimiter='\t' )
+    for chrom, idx, strand in parse( reader, columns=columns, shift=shift ):
+        parts.setdefault( chrom, [] ).append( (idx, strand) )
+    
+    results = []
+    for chrom, items in parts.items():
+        idx = numpy.concatenate( [ item[0] for item in items ] )
+        strand = numpy.concatenate( [ item[1] for item in items ] )
+        results.append( (chrom, idx, strand) )
+    return results, cut is not None
+
+def parse_parallel( fname, columns, shift, workers ):
+    """
+    Parses a file in byte ranges in a pool of worker processes,
+    generates the (chrom, idx, strand) tuples of the ranges in file order
+    """
+    import multiprocessing
+
+    start, end = data_range( fname )
+    count = max( workers, (end - start) / RANGE_SIZE + 1 )
+    tasks = [ (fname, lo, hi, columns, shift) for lo, hi in byte_ranges( fname, start, end, count ) ]
+
+    logger.info('parsing %s ranges with %s workers' % (len(tasks), workers))
+    pool = multiprocessing.Pool( workers )
+    try:
+        # a limited window of ranges is in flight, the results are consumed in order
+        tasks, pending = iter( tasks ), []
+        while True:
+            for params in islice( tasks, RANGE_WINDOW * workers - len(pending) ):
+                pending.append( pool.apply_async( parse_worker, (params, ) ) )
+            if not pending:
+                break
+            results, found = pending.pop(0).get()
+            for result in results:
+                yield result
+            # the ranges that follow the sequence start are not scheduled
+            if found:
+                break
+    finally:
+        pool.terminate()
+
+def write( sorter, outname, source, format ):
+    """
+    Writes the merged reads into a genetrack input file
+    """
+    fp = open(outname, 'wt')
 
     # create a few information headers
     fp.write("#\n# created with tabs2genetrack\n")
-    fp.write("# source: %s, format %s\n#\n" % (basename, format) )
+    fp.write("# source: %s, format %s\n#\n" % (source, format) )
     fp.write("chrom\tindex\tforward\treverse\tvalue\n")
-    
-    # the main reader
-    reader = csv.reader(open(inpname, 'rb'), delimiter='\t')
-
-    # will duplicate some code to avoid an extra conditional internally
-    chrom, index, fwd, rev, val = reader.next()
-    lastindex, fwd, rev, val = int(index), int(fwd), int(rev), int(val)
-    collect = [ chrom, lastindex, fwd, rev, val ]
-
-    for row in reader:
-        chrom, index, fwd, rev, val = row
-        index, fwd, rev, val = int(index), int(fwd), int(rev), int(val)
-        if index == lastindex:
-            collect[2] += fwd
-            collect[3] += rev
-            collect[4] += val
-        else:
-            # write out the collected data
-            fp.write( '%s\t%s\t%s\t%s\t%s\n' % tuple(collect) )
-            collect = [ chrom, index, fwd, rev, val ]
-            lastindex = index
+
+    for label in sorter.labels:
+        for records in sorter.merge( label ):
+            lines = [ '%s\t%s\t%s\t%s\t%s\n' % ( (label,) + row ) for row in records.tolist() ]
+            fp.write( ''.join(lines) )
 
     fp.close()
 
+def record_values( records ):
+    """
+    Transforms records into a value array of the positional data, 
+    see `genetrack.hdflib.parse_block`
+
+    >>> record_values( numpy.array( [ (5, 1, 0, 1) ], dtype=RECORD ) ).tolist()
+    [[5.0, 1.0, 0.0, 1.0]]
+    """
+    values = numpy.empty( (len(records), 4), numpy.float64 )
+    for pos, name in enumerate( hdflib.FIELDS ):
+        values[:, pos] = records[name]
+    return values
+
+class ReadIndex( hdflib.PositionalData ):
+    """
+    A PositionalData built from the merged runs of a ReadSorter,
+    the HDF tables are written without an intermediate text file.
+    """
+    def __init__(self, sorter, fname, index, **kwds):
+        self.sorter = sorter
+        hdflib.PositionalData.__init__(self, fname=fname, index=index, update=True, **kwds)
+
+    def expected_rows(self):
+        return dict( [ (label, self.sorter.rows( label )) for label in self.sorter.labels ] )
+
+    def label_runs(self):
+        for label in self.sorter.labels:
+            yield label, imap( record_values, self.sorter.merge( label ) )
+
 def transform(inpname, outname, format, shift=0, index=False, options=None):
     """
     Transforms reads stored in bedfile to a genetrack input file.
@@ -93,33 +560,22 @@ def transform(inpname, outname, format, shift=0, index=False, options=None):
         raise Exception('Invalid file format' % format)
 
     # two sanity checks, one day someone will thank me
-    if format == 'BED' and inpname.endswith('gff'):
+    plainname = re.sub( r'\.b?gz$', '', inpname )
+    if format == 'BED' and plainname.endswith('gff'):
         raise Exception('BED format on a gff file?')
-    if format == 'GFF' and inpname.endswith('bed'):
+    if format == 'GFF' and plainname.endswith('bed'):
         raise Exception('GFF format on a bed file?')
 
     # find the basename of the outputname
     basename = os.path.basename(outname)
    
-    # two files store intermediate results
-    flat = conf.tempdata( '%s.flat' % basename )
-    sorted  = conf.tempdata( '%s.sorted' % basename )
-
-    # check for track information on first line, 
-    # much faster this way than conditional checking on each line
-    fp = file(inpname, 'rU')
-    first = fp.readline()
-    fp.close()
-
-    # create the reader
-    reader = csv.reader(file(inpname, 'rU'), delimiter='\t')
-
-    # skip if trackline exists
-    if first.startswith == 'track':
-        reader.next()
-
-    # unwind the comments
-    list(takewhile(lambda x: x[0].startswith('#'), reader))
+    # the sorted runs are stored in a temporary file
+    if options and options.workdir:
+        if not os.path.isdir(options.workdir):
+            os.mkdir(options.workdir)
+        runs = conf.path_join( options.workdir, '%s.runs' % basename )
+    else:
+        runs = conf.tempdata( '%s.runs' % basename )
 
     # copious timing info for those who enjoy these
     timer, full = util.Timer(), util.Timer()
@@ -127,80 +583,79 @@ def transform(inpname, outname, format, shift=0, index=False, options=None):
     logger.debug("parsing '%s'" % inpname)
     logger.debug("output to '%s'" % outname)
 
-    # create the unsorted output file and apply corrections
-    logger.debug("unsorted flat file '%s'" % flat)
-
-    fp = file(flat, 'wt')
-    for linec, row in enumerate(reader):
-        try:
-            chrom, start, end, strand = row[CHROM], row[START], row[END], row[STRAND]
-        except Exception, exc:
-            first = row[0][0]
-            # may be hitting the end of the file with other comments
-            if  first == '>':
-                break # hit the sequence content of the gff file
-            elif first == '#':
-                continue # hit upon some comments
-            else:
-                logger.error(row)
-                raise Exception(exc) 
-
-        if strand == '+':
-            # on forward strand, 5' is at start
-            idx = int(start) + shift
-            fwd, rev, val = 1, 0, 1
-        elif strand == '-':
-            # on reverse strand, 5' is at end
-            idx = int(end) - shift
-            fwd, rev, val = 0, 1, 1
-        else:
-            # no strand specified, generate interval centers
-            idx = (int(start)+int(end))/2
-            fwd, rev, val = 0, 0, 1
-
-        # it is essential be able to sort the index as a string! 
-        fp.write('%s\t%012d\t%s\t%s\t%s\n' % (chrom, idx, fwd, rev, val))
+    # large files may be parsed in parallel, compressed 
+    # files are decompressed in parallel while being read
+    columns = (CHROM, START, END, STRAND)
+    workers = options and options.workers or 1
+    compressed = gziplib.is_gzip( inpname )
+    if workers > 1 and not compressed:
+        reads = parse_parallel( inpname, columns=columns, shift=shift, workers=workers )
+    else:
+        # check for track information on first line, 
+        # much faster this way than conditional checking on each line
+        fp = gziplib.open_input(inpname, 'rU')
+        first = fp.readline()
+        fp.close()
+
+        # create the reader
+        threads = workers > 1 and workers or gziplib.THREADS
+        reader = csv.reader(gziplib.open_input(inpname, 'rU', threads=threads), delimiter='\t')
+
+        # skip if trackline exists
+        if first.startswith('track'):
+            reader.next()
+
+        # unwind the comments, keeps the first row that follows them
+        reader = dropwhile(lambda x: x[0].startswith('#'), reader)
+        reads = parse( reader, columns=columns, shift=shift )
+
+    # small inputs are aggregated in memory, large ones are sorted in runs
+    if options is None:
+        limit = MEMORY_LIMIT
+    else:
+        limit = options.memory
+    footprint = hdflib.estimate_rows( inpname ) * READ_BYTES
+    if footprint < limit * 2**20:
+        logger.debug("aggregating in memory")
+        sorter = ReadCounter( limit=limit )
+    else:
+        logger.debug("sorted runs in '%s'" % runs)
+        sorter = ReadSorter( runs )
+    linec = 0
+    for chrom, idx, strand in reads:
+        sorter.add( chrom, idx, strand )
+        linec += len(idx)
 
-    fp.close()
     linet = util.commify(linec)
-    logger.debug("parsing %s lines finished in %s" % (linet, timer.report()))
-
-    # if it is producing coverage then it will expand reads into full intervaals
-
-    # now let the sorting commence
-    cmd = "sort %s > %s" % (flat, sorted)
-    logger.debug("sorting into '%s'" % sorted)
-    os.system(cmd)
-    logger.debug("sorting finished in %s" % timer.report() )
+    logger.debug("parsing and sorting %s lines finished in %s" % (linet, timer.report()))
 
-    logger.debug("consolidating into '%s'" % outname)
-    consolidate( sorted, outname, format=format)
-    logger.debug("consolidate finished in %s" % timer.report() )
+    # the genetrack text file is optional when indexing
+    if index:
+        gtrack = options and options.gtrack
+    else:
+        gtrack = outname
+    if gtrack:
+        logger.debug("merging into '%s'" % gtrack)
+        write( sorter, gtrack, source=basename, format=format )
+        logger.debug("merging finished in %s" % timer.report() )
+
+    # the index is built from the merged runs in the same pass,
+    # it is written to the output file, the workdir holds the runs
+    if index:
+        logger.debug("loading the index into '%s'" % outname)
+        if options is None:
+            options = option_parser().get_default_values()
+        sigmas = map( float, filter( None, options.sigmas.split(',') ) )
+        result = ReadIndex( sorter, fname=inpname, index=outname, complib=options.complib, 
+            complevel=options.complevel, compact=options.compact, sigmas=sigmas, step=options.step )
+        result.close()
+        logger.debug("indexing finished in %s" % timer.report() )
+    
     logger.debug("output saved to '%s'" % outname)
     logger.debug("full conversion finished in %s" % full.report() )
 
     # attempting to cleanup the remaining files
-    for name in (flat, sorted):
-        logger.debug("removing temporary file '%s'" % name )
-        os.remove(name)
-
-    # also runs the indexing on it
-    if index:
-        logger.debug("loading the index from '%s'" % outname)
-        # create the work directory
-        if options.workdir and not os.path.isdir(options.workdir):
-            os.mkdir(options.workdir)
-        result = hdflib.PositionalData(fname=outname, update=True, workdir=options.workdir)
-        logger.debug("indexing finished in %s" % timer.report() )
-        result.close()
-
-        logger.debug("moving index to main output '%s'" % outname )
-
-        # remove the intermediate file
-        os.remove(outname)
-
-        # move the index as the output file
-        shutil.move(result.index, outname)
+    sorter.close()
 
 def option_parser():
     "The option parser may be constructed in other tools invoking this script"
@@ -245,14 +700,61 @@ def option_parser():
         help="sets the verbosity (0, 1) (default=1)",
     )
 
+    parser.add_option(
+        '-m', '--memory', action="store", 
+        dest="memory", type="int", default=MEMORY_LIMIT, 
+        help="aggregates the reads in memory below this many megabytes (default=%s)" % MEMORY_LIMIT,
+    )
+
+    parser.add_option(
+        '--workers', action="store", 
+        dest="workers", type="int", default=1, 
+        help="the number of processes that parse the input (default=1)",
+    )
+
     parser.add_option("-x", "--index",
         action="store_true", dest="index", default=False,
-        help="also creates an hdf index for the file")
+        help="writes an hdf index to the output file instead of the genetrack input file")
+
+    # the build options of the index, same as in hdf_loader
+    parser.add_option(
+        '--complib', action="store", 
+        dest="complib", type='str', default=None,
+        help="compression library of the index: zlib, lzo, bzip2 or blosc (default=no compression)"
+    )
+
+    parser.add_option(
+        '--complevel', action="store", 
+        dest="complevel", type='int', default=5,
+        help="compression level 1-9 (default=5)"
+    )
+
+    parser.add_option("--compact",
+        action="store_true", dest="compact", default=False,
+        help="stores the index as 32 bit integers and floats")
+
+    parser.add_option(
+        '--sigmas', action="store", 
+        dest="sigmas", type='str', default='',
+        help="comma separated sigmas of the smoothed tables stored in the index (default=none)"
+    )
+
+    parser.add_option(
+        '--step', action="store", 
+        dest="step", type='int', default=1,
+        help="stores every step-th position of the smoothed tables (default=1)"
+    )
+
+    parser.add_option(
+        '-g', '--gtrack', action="store", 
+        dest="gtrack", type='str', default=None,
+        help="also writes the genetrack input file when indexing (optional)"
+    )
 
     parser.add_option(
         '-w', '--workdir', action="store", 
         dest="workdir", type='str', default=None,
-        help="work directory (optional)"
+        help="work directory of the temporary files (optional)"
     )
 
     return parser
@@ -212,9 +212,9 @@ class Data( models.Model ):
             return None
 
     def index(self):
-        "Returns the underlying representation of the data"
+        "Returns the underlying representation of the data, shared across requests"
         from genetrack import hdflib
-        index = hdflib.PositionalData(fname=self.content.path, nobuild=True)
+        index = hdflib.POOL.get(fname=self.content.path)
         return index
 
     def result_count(self):
@@ -436,4 +436,4 @@ signals.post_save.connect( result_save_trigger, sender=Result )
 
 signals.post_delete.connect( data_delete_trigger, sender=Data )
 
-signals.post_save.connect( user_profile_trigger, sender=User )
\ No newline at end of file
+signals.post_save.connect( user_profile_trigger, sender=User )
\ No newline at end of file
@@ -21,22 +21,21 @@ def dataview_populate(json, index, params):
     Operates on a single data and populates the data in the json from it.
     """
 
-    results = index.query(start=params.start, end=params.end, label=params.chrom)
+    results = index.query(start=params.start, end=params.end, label=params.chrom, fields=('idx', 'val'), dtype=browserutils.DTYPE)
     
     fitdata = []
-    data = map(list, (results.idx,results.val))
+    data = [ results.idx, results.val ]
     xscale = (params.start, params.end)
     
     for row in json:
         style = row['style']
         if style.startswith('FIT'):
             # fit the data
-            fitdata = fitlib.gaussian_smoothing(data[0], data[1], sigma=params.sigma, epsilon=0.01 )
-            fitdata = map(list, fitdata)
+            fitdata = browserutils.fit( x=data[0], y=data[1], params=params )
             row['data'] = fitdata
         elif  style.startswith('SEGMENT'):
             assert fitdata, 'smoothing must be applied first'
-            peakdata = fitlib.fixed_width_predictor( x=fitdata[0], y=fitdata[1], params=params )
+            peakdata = browserutils.peaks( x=fitdata[0], y=fitdata[1], params=params )
             row['data'] = peakdata
         else:
             row['data'] = data
@@ -119,7 +118,7 @@ def galaxy(request):
     workdir = conf.path_join(path, name+"_files")
     print workdir
     
-    index = hdflib.PositionalData(fname='', index=filename, nobuild=True, workdir=workdir)
+    index = hdflib.POOL.get(fname='', index=filename, workdir=workdir)
     #url = urlib.urlencode()
     url = "/galaxy/?filename=%s&hashkey=%s&input=%s&GALAXY_URL=%s" % (encoded, hashkey, dataid, galaxy_url)
     return browser(request=request, index=index, url=url, dataid=dataid, galaxy_url=galaxy_url)
@@ -152,7 +151,7 @@ def browser(request, index, url, galaxy_url, dataid=0):
         
         # TODO make parameters names consistent across Galaxy, GeneTrack and script!
         strand = 'all' if params.strand=='ALL' else 'two'
-        mode = 'nolap' if params.smoothing_func =='GK' else 'all'
+        mode = 'nolap' if params.feature_width else 'all'
 
         urlparams = dict(
             strand = strand,
@@ -161,7 +160,7 @@ def browser(request, index, url, galaxy_url, dataid=0):
             mode=mode,
             sigma=int(params.sigma),
             input=dataid,
-            method='gauss',
+            method=fitlib.KERNEL_METHODS[params.smoothing_func],
             runtool_btn="Execute"
         )
 
@@ -172,8 +171,7 @@ def browser(request, index, url, galaxy_url, dataid=0):
     multi = dataview_multiplot(index=index, params=params, debug=False)
     params.image_height = multi.h
     
-    # close the data
-    index.close()
+    # the index stays open in the pool for the following requests
 
     # trigger the occasional cache cleaning
     webutil.cache_clean(age=1, chance=10)
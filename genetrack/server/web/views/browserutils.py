@@ -1,7 +1,7 @@
 """
 Browser related utility functions
 """
-
+import numpy
 from genetrack.server.web import html
 from genetrack.server.web.views import formspec
 from genetrack import logger, conf, hdflib, util, fitlib
@@ -9,6 +9,9 @@ from genetrack import logger, conf, hdflib, util, fitlib
 # the limit over which smoothing will be disabled
 SMOOTH_LIMIT = 50000
 
+# the precision of the values that are displayed
+DTYPE = numpy.float32
+
 # this padding is currently empirical, todo: generate automatically
 IMAGE_PADDING = 120
 
@@ -27,15 +30,42 @@ TWOSTRAND_PEAK1 = "color=BLUE 10%%; style=SEGMENT; data=1; bpad=1; legend=Forwar
 TWOSTRAND_PEAK2 = "color=RED 10%%;  style=SEGMENT; data=1; bpad=1; legend=Reverse peaks; strand=-; target=last; offset=-25; label_offset=-15"
 
 def fit(x, y, params):
-    "Fits the x and y data"
-    fx, fy = fitlib.gaussian_smoothing(x, y, sigma=params.sigma, epsilon=0.01 )
-    return list(fx), list(fy)
-
-def peaks(x, y, params):
-    "Returns peaks for x and y data"
-    data = fitlib.fixed_width_predictor( x=x, y=y, params=params )
+    "Fits the x and y data, returns numpy arrays"
+    fx, fy = fitlib.gaussian_smoothing(x, y, sigma=params.sigma, epsilon=0.01, kernel=params.smoothing_func, dtype=DTYPE )
+    return fx, fy
+
+def peaks(x, y, params, step=1):
+    "Returns peaks for x and y data, the x coordinates are step apart"
+    predictor = fitlib.PREDICTORS[ params.pred_func ]
+    data = predictor( x=x, y=y, params=params, step=step )
     return data
 
+def stored_peaks(index, params):
+    """
+    Returns the lists of peaks stored next to the index, one list for 
+    the combined strands or two lists for the forward and reverse strands.
+    Returns None when there are no stored peaks predicted with the current parameters.
+    """
+    data = index.peak_data()
+    if data is None or params.pred_func != 'FIX':
+        return None
+    
+    attrs = data.attrs
+    same = (attrs.sigma, attrs.exclusion, attrs.level) == (params.sigma, params.feature_width, params.minimum_peak)
+    same = same and attrs.get( 'method', 'gauss' ) == fitlib.KERNEL_METHODS[ params.smoothing_func ]
+    twostrand = attrs.strand == 'two'
+    if not same or attrs.predictor == 'all' or twostrand == params.merge_strands:
+        return None
+
+    def select(strand):
+        res = data.query(params.chrom, params.start, params.end, strand=strand)
+        return fitlib.label_peaks(res.start, res.end, res.value, params)
+    
+    if params.merge_strands:
+        return [ select(None) ]
+    else:
+        return [ select('+'), select('-') ]
+
 def index_populate(json, index, params):
     """
     Populates a data view from an index
@@ -44,11 +74,36 @@ def index_populate(json, index, params):
     of the json spec.
     """
 
+    # smoothing needs the raw data, otherwise wide views 
+    # are served from the summary tables, one bin per pixel
+    pixels = not params.use_smoothing and params.image_width or None
+
+    # the composite view uses only the combined values
+    if params.merge_strands:
+        fields = ( 'idx', 'val' )
+    else:
+        fields = ( 'idx', 'fwd', 'rev' )
+
     # peform the query
-    res = index.query(start=params.start, end=params.end, label=params.chrom, aslist=True)
+    # the arrays are passed on to the renderer as they are
+    res = index.query(start=params.start, end=params.end, label=params.chrom, pixels=pixels, fields=fields, dtype=DTYPE)
     
-    # compute smoothing before plotting
-    if params.use_smoothing:
+    # the smoothed data may be precomputed in the index
+    stored = None
+    if params.use_smoothing and params.smoothing_func == 'GK':
+        stored = index.query_smooth(label=params.chrom, start=params.start, end=params.end, sigma=params.sigma, fields=fields, dtype=DTYPE)
+
+    # compute smoothing before plotting, the stored 
+    # tables may keep only every step-th position
+    step = 1
+    if stored:
+        step = stored.step
+        if params.merge_strands:
+            res.fx, res.fy = stored.idx, stored.val
+        else:
+            res.fx1, res.fy1 = stored.idx, stored.fwd
+            res.fx2, res.fy2 = stored.idx, stored.rev
+    elif params.use_smoothing:
         if params.merge_strands:
             res.fx, res.fy = fit(x=res.idx, y=res.val, params=params)
         else:
@@ -59,11 +114,17 @@ def index_populate(json, index, params):
     # compute all peak predictions before plotting
     if params.use_predictor:
         assert params.use_smoothing, 'Smoothing has not been turned on!'
-        if params.merge_strands:
-            res.peaks = peaks(x=res.fx, y=res.fy, params=params)
+        found = stored_peaks(index, params)
+        if found is not None:
+            if params.merge_strands:
+                res.peaks, = found
+            else:
+                res.peaks1, res.peaks2 = found
+        elif params.merge_strands:
+            res.peaks = peaks(x=res.fx, y=res.fy, params=params, step=step)
         else:
-            res.peaks1 = peaks(x=res.fx1, y=res.fy1, params=params)
-            res.peaks2 = peaks(x=res.fx2, y=res.fy2, params=params) 
+            res.peaks1 = peaks(x=res.fx1, y=res.fy1, params=params, step=step)
+            res.peaks2 = peaks(x=res.fx2, y=res.fy2, params=params, step=step) 
     
     # shortcuts
     isfit  = lambda x: x.startswith('FIT')
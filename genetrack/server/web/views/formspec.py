@@ -7,7 +7,7 @@ form specficators/validators need to be genereated on the fly.
 
 from itertools import starmap
 from django import forms
-from genetrack import logger, util
+from genetrack import logger, util, fitlib
 
 # needs a custom class to create a submit widget
 class SubmitWidget( forms.widgets.Input) :
@@ -83,7 +83,7 @@ class FitForm( forms.Form ):
     """
     use_smoothing = forms.BooleanField( initial=False, required=False )
     sigma = forms.FloatField( initial=20, max_value=1000, min_value=0, widget=ImageWidget )
-    smoothing_func = forms.ChoiceField( initial='GK', choices=[ ('GK', 'Gaussian kernel') ] )
+    smoothing_func = forms.ChoiceField( initial='GK', choices=fitlib.KERNEL_CHOICES )
     minimum_peak = forms.FloatField( initial=2, max_value=1000, min_value=0, widget=FloatWidget )
 
 FIT_DEFAULTS = get_defaults( FitForm() )
@@ -98,7 +98,7 @@ class PeakForm( forms.Form ):
     """
     use_predictor = forms.BooleanField( initial=False, required=False )
     feature_width = forms.IntegerField( initial=147, max_value=2000, min_value=0, widget=ImageWidget )
-    pred_func = forms.ChoiceField( initial='FIX', choices=[ ('FIX', 'Fixed width'), ('TRS', 'Above threshold'), ('ALL', 'All maxima') ] )
+    pred_func = forms.ChoiceField( initial='FIX', choices=[ ('FIX', 'Fixed width'), ('ADP', 'Adaptive width'), ('TRS', 'Above threshold'), ('ALL', 'All maxima') ] )
 
 PEAK_DEFAULTS = get_defaults( PeakForm() )
 
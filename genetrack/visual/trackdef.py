@@ -178,12 +178,20 @@ def unwind_segments(data):
     fast[2::3] = [ NOVALUE ] * len(labels)
     return fast, labels
 
+def as_list(values):
+    "The chart library takes lists, numpy arrays are converted in a single step"
+    if hasattr(values, 'tolist'):
+        return values.tolist()
+    return values
+
 def scaling(y, options):
     if options.scaling!=1:
         s = options.scaling
+        if hasattr(y, 'tolist'):
+            return (y * s).tolist()
         return map(lambda x: x*s, y )
     else:
-        return y
+        return as_list(y)
 
 def get_axis(track, o):
     "Attempts to select a new axis"
@@ -196,7 +204,7 @@ def draw_bars(track, data, options=None):
     o = options or track.o
     x, y = data
     
-    y = scaling(y, options)
+    x, y = as_list(x), scaling(y, options)
     layer = track.c.addBarLayer(y, color=o.color, name=o.legend)
     layer.setBarWidth(o.lw)
     layer.setBorderColor(o.color)
@@ -210,7 +218,7 @@ def draw_area(track, data, options=None):
     o = options or track.o
     x, y = data
     
-    y = scaling(y, options)
+    x, y = as_list(x), scaling(y, options)
     layer = track.c.addAreaLayer(y, color=o.color, name=o.legend)
     axis = get_axis(track, options)
     layer.setLineWidth(o.lw)
@@ -224,7 +232,7 @@ def draw_scatter(track, data, options):
     "Draws lines data=(x,y)"
     o = options or track.o
     x, y = data
-    y = scaling(y, options)
+    x, y = as_list(x), scaling(y, options)
     layer  = track.c.addScatterLayer(x, y, o.legend, pychartdir.CircleShape, o.lw, o.color)
     
     # select axes
@@ -246,7 +254,7 @@ def draw_linelayer(track, data, options, func):
     "Draws lines data=(x,y)"
     o = options or track.o
     x, y = data
-    y = scaling(y, options)
+    x, y = as_list(x), scaling(y, options)
     layer = func(y, o.color, o.legend)
     layer.setLineWidth(o.lw)
     layer.setBorderColor(o.color)
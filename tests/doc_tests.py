@@ -3,7 +3,7 @@ This script runs the doctests
 """
 import testlib
 import os, unittest, doctest
-from genetrack import data, hdflib
+from genetrack import data, hdflib, fitlib, flatlib, peaklib, gziplib
 
 def codetest():
     "Test the code here before adding to doctest"
@@ -17,7 +17,7 @@ def get_suite():
     ]
 
     module_names = [
-        data, hdflib
+        data, hdflib, fitlib, flatlib, peaklib, gziplib
     ]
 
     # needs relative paths for some reason
@@ -1,15 +1,263 @@
-import os, unittest, random
+import os, unittest, random, bisect
+import numpy
 
 import testlib
-from genetrack import conf, util, logger
+from genetrack import conf, util, logger, hdflib, fitlib
 
 class Hdflib( unittest.TestCase ):
     'basic sequence class tests'
     
+    def setUp(self):
+        fname = conf.testdata('test-hdflib-input.txt', verify=True)
+        self.index = hdflib.PositionalData(fname=fname, workdir=conf.TEMP_DATA_DIR)
+
+    def tearDown(self):
+        self.index.close()
+
     def test_all(self):
         "Testing sequence operations"
         #self.assertEqual(1, 0)
 
+    def test_indices(self):
+        "Testing the sampled index search"
+        for label in self.index.labels:
+            column = self.index.table(label).cols.idx[:]
+            values = [ 0, column[0], column[-1], column[-1] + 1 ]
+            values += [ random.randint(0, column[-1]) for i in range(100) ]
+            values += list( column[::hdflib.SAMPLE] )
+            for value in values:
+                expect = bisect.bisect_left(column, value)
+                self.assertEqual( self.index.search( self.index.table(label), value ), expect )
+
+    def test_expected_rows(self):
+        "Testing the row estimates of each label"
+        estimates = self.index.expected_rows()
+        for label in self.index.labels:
+            rows = len( self.index.table(label) )
+            self.assertTrue( rows / 2 < estimates[label] < rows * 2 )
+
+    def test_compact(self):
+        "Testing the compressed and compact layout"
+        fname = conf.testdata('test-hdflib-input.txt', verify=True)
+        index = conf.tempdata('test-hdflib-compact.hdf')
+        compact = hdflib.PositionalData(fname=fname, index=index, update=True, complib='zlib', compact=True)
+        for label in self.index.labels:
+            res1 = self.index.query(label, 0, 10**6)
+            res2 = compact.query(label, 0, 10**6)
+            for name in hdflib.FIELDS:
+                self.assertEqual( list(getattr(res1, name)), list(getattr(res2, name)) )
+        self.assertEqual( compact.table('chr1').filters.complib, 'zlib' )
+        compact.close()
+
+    def test_parallel(self):
+        "Testing the parallel build"
+        fname = conf.testdata('test-hdflib-input.txt', verify=True)
+        index = conf.tempdata('test-hdflib-parallel.hdf')
+        parallel = hdflib.PositionalData(fname=fname, index=index, update=True, workers=2)
+        self.assertEqual( parallel.labels, self.index.labels )
+        for label in self.index.labels:
+            self.assertEqual( parallel.zoom_levels(label), self.index.zoom_levels(label) )
+            table1, table2 = self.index.table(label), parallel.table(label)
+            self.assertEqual( table1.read().tolist(), table2.read().tolist() )
+            table1 = self.index.zoom_table(label, binsize=100)
+            table2 = parallel.zoom_table(label, binsize=100)
+            self.assertEqual( table1.read().tolist(), table2.read().tolist() )
+        parallel.close()
+
+    def test_compressed(self):
+        "Testing the build from compressed inputs"
+        from genetrack import gziplib
+        fname = conf.testdata('test-hdflib-input.txt', verify=True)
+        gzname = gziplib.bgzip( fname, conf.tempdata('test-hdflib-input.txt.gz') )
+        index = conf.tempdata('test-hdflib-compressed.hdf')
+        compressed = hdflib.PositionalData(fname=gzname, index=index, update=True, workers=2)
+        self.assertEqual( compressed.labels, self.index.labels )
+        for label in self.index.labels:
+            table1, table2 = self.index.table(label), compressed.table(label)
+            self.assertEqual( table1.read().tolist(), table2.read().tolist() )
+        compressed.close()
+
+    def test_smooth(self):
+        "Testing the smoothed tables"
+        fname = conf.testdata('test-hdflib-input.txt', verify=True)
+        index = conf.tempdata('test-hdflib-smooth-parallel.hdf')
+        parallel = hdflib.PositionalData(fname=fname, index=index, update=True, workers=2, sigmas=[5, 20], step=2)
+        for label in self.index.labels:
+            self.assertEqual( parallel.smooth_levels(label), [ (5, 2), (20, 2) ] )
+            
+            # compare to smoothing the whole label at once
+            data = self.index.query(label, 0, 10**9)
+            fx, fy = fitlib.gaussian_smoothing(data.idx, data.fwd, sigma=20, epsilon=-1)
+            fx, vy = fitlib.gaussian_smoothing(data.idx, data.val, sigma=20, epsilon=-1)
+            keep = (vy > hdflib.SMOOTH_EPSILON) & (fx % 2 == 0)
+            results = parallel.query_smooth(label, 0, 10**9, sigma=20)
+            self.assertEqual( results.idx.tolist(), fx[keep].tolist() )
+            self.assertTrue( numpy.allclose( results.fwd, fy[keep] ) )
+        parallel.close()
+
+    def test_smooth_step(self):
+        "Testing the region predictors on smoothed tables that skip positions"
+        fname = conf.testdata('test-hdflib-input.txt', verify=True)
+        index = conf.tempdata('test-hdflib-smooth-step.hdf')
+        stepped = hdflib.PositionalData(fname=fname, index=index, update=True, sigmas=[20], step=2)
+        params = util.Params(minimum_peak=2, feature_width=40, zoom_value=1)
+        for label in self.index.labels:
+            data = self.index.query(label, 0, 10**9)
+            fx, fy = fitlib.gaussian_smoothing(data.idx, data.val, sigma=20, epsilon=0.01)
+            stored = stepped.query_smooth(label, 0, 10**9, sigma=20)
+            self.assertEqual( stored.step, 2 )
+            for code in ( 'TRS', 'ADP' ):
+                predictor = fitlib.PREDICTORS[code]
+                expect = predictor(fx, fy, params=params)
+                found  = predictor(stored.idx, stored.val, params=params, step=stored.step)
+                
+                # the skipped positions may lose a few marginal regions
+                self.assertTrue( 0.95 * len(expect) <= len(found) <= len(expect) )
+                starts = numpy.array( [ start for start, end, text in expect ] )
+                ends   = numpy.array( [ end for start, end, text in expect ] )
+                for start, end, text in found:
+                    close = (abs(starts - start) <= stored.step) & (abs(ends - end) <= stored.step)
+                    self.assertTrue( close.any() )
+        stepped.close()
+
+    def test_fft_peaks(self):
+        "Testing that the direct and the fourier convolutions select the same peaks"
+        limit = fitlib.FFT_LIMIT
+        try:
+            for sigma in (5, 50):
+                for label in self.index.labels:
+                    table = self.index.table(label)
+                    x, y = table.col('idx'), table.col('val')
+                    found = []
+                    for fitlib.FFT_LIMIT in (10**9, 0):
+                        fx, fy = fitlib.gaussian_smoothing( x, y, sigma=sigma, epsilon=0.01 )
+                        found.append( fitlib.select_peaks( fitlib.detect_peaks( fx, fy ), exclusion=1 ) )
+                    self.assertEqual( [ p for p, v in found[0] ], [ p for p, v in found[1] ] )
+        finally:
+            fitlib.FFT_LIMIT = limit
+
+    def test_pool(self):
+        "Testing the shared instances of the index pool"
+        import threading
+        fname = conf.testdata('test-hdflib-input.txt', verify=True)
+        index = conf.tempdata('test-hdflib-pool.hdf')
+        hdflib.PositionalData(fname=fname, index=index, update=True).close()
+        pool = hdflib.IndexPool()
+        expect = [ self.index.query('chr2', start, start + 2000).idx.tolist() for start in range(0, 50000, 1000) ]
+        
+        errors = []
+        def worker():
+            try:
+                for pos, start in enumerate( range(0, 50000, 1000) ):
+                    data = pool.get(fname=fname, index=index)
+                    if data.query('chr2', start, start + 2000).idx.tolist() != expect[pos]:
+                        errors.append( start )
+            except Exception, exc:
+                errors.append( exc )
+        threads = [ threading.Thread(target=worker) for i in range(4) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual( errors, [] )
+
+        # a rebuilt index is reopened even within the same second
+        data = pool.get(fname=fname, index=index)
+        stamp = os.path.getmtime(index)
+        data.close()
+        hdflib.PositionalData(fname=fname, index=index, update=True, compact=True).close()
+        os.utime(index, (stamp, stamp))
+        self.assertTrue( data is not pool.get(fname=fname, index=index) )
+
+    def test_pool_flat(self):
+        "Testing that the pool opens the flat index converted next to the HDF index"
+        import shutil
+        from genetrack import flatlib
+        from genetrack.scripts import hdf2flat
+        fname = conf.testdata('test-hdflib-input.txt', verify=True)
+        index = conf.tempdata('test-hdflib-pool-flat.hdf')
+        hdflib.PositionalData(fname=fname, index=index, update=True).close()
+        if os.path.isdir( flatlib.flat_path(index) ):
+            shutil.rmtree( flatlib.flat_path(index) )
+        self.assertEqual( hdf2flat.transform( index ), flatlib.flat_path(index) )
+
+        pool = hdflib.IndexPool()
+        data = pool.get(fname=fname, index=index)
+        self.assertTrue( isinstance(data, flatlib.FlatData) )
+        self.assertEqual( list( data.query('chr2', 0, 5000).idx ), list( self.index.query('chr2', 0, 5000).idx ) )
+
+        # a flat index older than the HDF index is not used
+        stamp = os.path.getmtime(index) + 10
+        os.utime(index, (stamp, stamp))
+        self.assertFalse( isinstance(pool.get(fname=fname, index=index), flatlib.FlatData) )
+
+    def test_merge(self):
+        "Testing the merge in blocks"
+        def blocks( values ):
+            cuts = sorted( random.sample( xrange(1, len(values)), 20 ) )
+            return numpy.split( values, cuts )
+        for label in self.index.labels:
+            table  = self.index.table(label)
+            values = numpy.column_stack( [ table.col(name) for name in hdflib.FIELDS ] ).astype( numpy.float64 )
+            other  = values[::3].copy()
+            other[:, 0] += 1
+            merged = numpy.concatenate( list( hdflib.merge_runs( blocks(values), blocks(other) ) ) )
+            self.assertEqual( merged.tolist(), hdflib.merge_values( values, other ).tolist() )
+
+        # the merged index is repacked
+        fname = conf.testdata('test-hdflib-input.txt', verify=True)
+        sizes = []
+        for reclaim in (False, True):
+            index = conf.tempdata('test-hdflib-merge-%s.hdf' % reclaim)
+            data = hdflib.PositionalData(fname=fname, index=index, update=True)
+            data.merge( fname, reclaim=reclaim )
+            for label in data.labels:
+                self.assertEqual( data.table(label).col('val').tolist(), [ 2 * x for x in self.index.table(label).col('val') ] )
+            data.close()
+            sizes.append( os.path.getsize(index) )
+        self.assertTrue( sizes[1] < sizes[0] )
+
+    def test_merge_layout(self):
+        "Testing that the merged labels keep the layout of the index"
+        fname = conf.testdata('test-hdflib-input.txt', verify=True)
+        index = conf.tempdata('test-hdflib-merge-layout.hdf')
+        hdflib.PositionalData(fname=fname, index=index, update=True, complib='zlib', compact=True, sigmas=[5]).close()
+
+        # a new label and an existing one
+        mergename = conf.tempdata('test-hdflib-merge-layout.txt')
+        fp = file(mergename, 'wt')
+        fp.write( 'chrom\tindex\tforward\treverse\tvalue\n' )
+        for label in ('chr1', 'chr4'):
+            for row in self.index.table('chr1').read(0, 1000).tolist():
+                fp.write( '\t'.join( map(str, (label,) + row) ) + '\n' )
+        fp.close()
+
+        # opened with the default layout
+        data = hdflib.PositionalData(fname=fname, index=index, nobuild=True)
+        self.assertEqual( data.merge( mergename ), ['chr1', 'chr4'] )
+        for label in ('chr1', 'chr2', 'chr4'):
+            table = data.table(label)
+            self.assertEqual( table.dtype, data.table('chr3').dtype )
+            self.assertEqual( table.filters.complib, 'zlib' )
+            self.assertEqual( data.smooth_levels(label), [ (5, 1) ] )
+        self.assertEqual( data.table('chr4').read().tolist(), self.index.table('chr1').read(0, 1000).tolist() )
+        data.close()
+
+    def test_query_many(self):
+        "Testing the batch queries"
+        regions = []
+        for label in self.index.labels:
+            for i in range(50):
+                start = random.randint(0, 90000)
+                regions.append( (label, start, start + random.randint(0, 5000)) )
+        random.shuffle( regions )
+        results = self.index.query_many( regions )
+        for pos, (label, start, end) in enumerate( regions ):
+            lo, hi = results.offsets[pos], results.offsets[pos+1]
+            expect = self.index.query( label, start, end )
+            for name in hdflib.FIELDS:
+                self.assertEqual( list(getattr(results, name)[lo:hi]), list(getattr(expect, name)) )
+
 def get_suite():
     "Returns the testsuite"
     tests  = [ 
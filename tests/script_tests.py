@@ -16,6 +16,182 @@ class ScriptTests( unittest.TestCase ):
         outfile = conf.tempdata('short-data.genetrack')
         tabs2genetrack.transform(inpfile, outfile, format='BED')
 
+        # the reads are sorted in runs when these do not fit into memory
+        parser  = tabs2genetrack.option_parser()
+        options, args = parser.parse_args( [ '--memory', '0' ] )
+        sortfile = conf.tempdata('short-data-sorted.genetrack')
+        tabs2genetrack.transform(inpfile, sortfile, format='BED', options=options)
+        self.assertEqual( file(sortfile).readlines()[3:], file(outfile).readlines()[3:] )
+
+        # parallel parsing produces the same output
+        options, args = parser.parse_args( [ '--workers', '2' ] )
+        tabs2genetrack.transform(inpfile, sortfile, format='BED', options=options)
+        self.assertEqual( file(sortfile).readlines()[3:], file(outfile).readlines()[3:] )
+
+        # the sequences that follow the features of gff files are skipped
+        gffin = conf.tempdata('short-data.gff')
+        fp = file(gffin, 'wt')
+        fp.write( '##gff-version 3\n' )
+        for line in file(inpfile):
+            chrom, start, end, name, score, strand = line.split()
+            fp.write( '\t'.join( [ chrom, 'test', 'read', start, end, score, strand, '.', '.' ] ) + '\n' )
+        fp.write( '##FASTA\n>seq\n' + 'ACGTACGT\n' * 5000 )
+        fp.close()
+        tabs2genetrack.transform(gffin, sortfile, format='GFF', options=options)
+        self.assertEqual( file(sortfile).readlines()[3:], file(outfile).readlines()[3:] )
+
+        # the ranges within the sequences end the data without errors
+        size = os.path.getsize(gffin)
+        columns = (0, 3, 4, 6)
+        self.assertEqual( tabs2genetrack.parse_worker( (gffin, size - 900, size, columns, 0) ), ([], True) )
+        default = tabs2genetrack.RANGE_SIZE
+        try:
+            tabs2genetrack.RANGE_SIZE = 2**10
+            tabs2genetrack.transform(gffin, sortfile, format='GFF', options=options)
+        finally:
+            tabs2genetrack.RANGE_SIZE = default
+        self.assertEqual( file(sortfile).readlines()[3:], file(outfile).readlines()[3:] )
+
+        # compressed inputs produce the same output
+        from genetrack import gziplib
+        gzname = gziplib.bgzip( inpfile, conf.tempdata('short-data.bed.gz'), size=2**12 )
+        tabs2genetrack.transform(gzname, sortfile, format='BED', options=options)
+        self.assertEqual( file(sortfile).readlines()[3:], file(outfile).readlines()[3:] )
+
+        # each read is counted once at a sorted, unique position
+        lines = [ line.split() for line in file(outfile) if not line.startswith('#') ][1:]
+        self.assertEqual( sum( [ int(line[4]) for line in lines ] ), 1000 )
+        keys = [ (chrom, int(index)) for chrom, index, fwd, rev, value in lines ]
+        self.assertEqual( keys, sorted( set(keys) ) )
+
+        # the index built in one pass matches the index of the text file
+        from genetrack import hdflib
+        parser  = tabs2genetrack.option_parser()
+        options, args = parser.parse_args( [ '--gtrack', outfile, '--complib', 'zlib', '--sigmas', '5' ] )
+        indexfile = conf.tempdata('short-data.hdf')
+        tabs2genetrack.transform(inpfile, indexfile, format='BED', shift=5, index=True, options=options)
+        direct = hdflib.PositionalData(fname=inpfile, index=indexfile, nobuild=True)
+        loaded = hdflib.PositionalData(fname=outfile, workdir=conf.TEMP_DATA_DIR, update=True)
+        self.assertEqual( direct.labels, loaded.labels )
+        for label in direct.labels:
+            self.assertEqual( direct.table(label).read().tolist(), loaded.table(label).read().tolist() )
+            self.assertEqual( direct.zoom_levels(label), loaded.zoom_levels(label) )
+            self.assertEqual( direct.smooth_levels(label), [ (5, 1) ] )
+        self.assertEqual( direct.table('chr1').filters.complib, 'zlib' )
+        direct.close()
+        loaded.close()
+
+    def test_count_positions(self):
+        "Testing that counting the reads in memory matches the sorted counts and is faster"
+        import numpy, time
+        from genetrack.scripts import tabs2genetrack
+        size = 10**6
+        for span in ( size, size * 16, size * 10**3 ):
+            idx = numpy.random.randint( 0, span, size ).astype( numpy.int64 )
+            strand = numpy.random.randint( 0, 3, size ).astype( numpy.int8 )
+            start = time.time()
+            counted = tabs2genetrack.count_positions( idx, strand )
+            middle = time.time()
+            records = tabs2genetrack.count_records( idx, strand )
+            end = time.time()
+            self.assertEqual( counted.tolist(), records.tolist() )
+            self.assertTrue( middle - start < end - middle )
+        
+        # spans over the memory limit are counted via numpy.unique
+        counted = tabs2genetrack.count_positions( idx[:1000] * 10**6, strand[:1000], limit=1 )
+        self.assertEqual( counted.tolist(), tabs2genetrack.count_records( idx[:1000] * 10**6, strand[:1000] ).tolist() )
+
+    def test_eland2gff(self):
+        "Testing the eland transformation of compressed inputs"
+        import gzip
+        from genetrack.scripts import eland2gff
+
+        inpfile = conf.testdata('eland-short.txt', verify=True)
+        outfile = conf.tempdata('eland-short.gff')
+        eland2gff.transform(inpfile, size=36, outname=outfile)
+        
+        gzname = conf.tempdata('eland-short.txt.gz')
+        fp = gzip.open(gzname, 'wb')
+        fp.writelines( file(inpfile) )
+        fp.close()
+        gzout = conf.tempdata('eland-short-gz.gff')
+        eland2gff.transform(gzname, size=36, outname=gzout)
+        self.assertEqual( file(gzout).readlines()[2:], file(outfile).readlines()[2:] )
+
+    def test_peakpred(self):
+        "Testing that chunked peak prediction matches the whole chromosome"
+        from genetrack import hdflib, fitlib
+        from genetrack.scripts import peakpred
+
+        inpfile = conf.testdata('test-hdflib-input.txt', verify=True)
+        outfile = conf.tempdata('test-hdflib-predictions.bed')
+        parser  = peakpred.option_parser()
+        options, args = parser.parse_args( [ '--sigma', '5', '--exclusion', '20', '--level', '0.5' ] )
+        
+        index = hdflib.PositionalData(fname=inpfile, workdir=conf.TEMP_DATA_DIR)
+        expected = []
+        for label in index.labels:
+            res = index.query(label, 0, 10**9)
+            fx, fy = fitlib.gaussian_smoothing(x=res.idx, y=res.val, sigma=5, epsilon=0.5)
+            peaks = fitlib.detect_peaks(x=fx, y=fy)
+            peaks = fitlib.select_peaks(peaks=peaks, exclusion=20, threshold=0.5)
+            expected.extend( [ (label, mid) for mid, value in peaks ] )
+        index.close()
+
+        # small chunks produce many seams
+        options.workdir = conf.TEMP_DATA_DIR
+        for maxsize in [ 100, 10**6 ]:
+            options.maxsize = maxsize
+            peakpred.predict(inpfile, outfile, options)
+            lines = [ line.split() for line in file(outfile) ]
+            found = [ (chrom, int(start) + 10) for chrom, start, end, dot, value, strand in lines ]
+            self.assertEqual( found, expected )
+
+        # the other kernels are selected by their method names
+        options.method = 'uniform'
+        peakpred.predict(inpfile, outfile, options)
+        lines = [ line.split() for line in file(outfile) ]
+        index = hdflib.PositionalData(fname=inpfile, workdir=conf.TEMP_DATA_DIR)
+        res = index.query('chr1', 0, 10**9)
+        fx, fy = fitlib.gaussian_smoothing(x=res.idx, y=res.val, sigma=5, epsilon=0.5, kernel='UK')
+        peaks = fitlib.select_peaks(peaks=fitlib.detect_peaks(x=fx, y=fy), exclusion=20, threshold=0.5)
+        index.close()
+        found = [ int(start) + 10 for chrom, start, end, dot, value, strand in lines if chrom == 'chr1' ]
+        self.assertEqual( found, [ mid for mid, value in peaks ] )
+        options.method = 'gauss'
+
+        # parallel prediction produces the same output
+        options.strand = peakpred.TWOSTRAND
+        peakpred.predict(inpfile, outfile, options)
+        serial = file(outfile).read()
+        options.workers = 2
+        peakpred.predict(inpfile, outfile, options)
+        self.assertEqual( file(outfile).read(), serial )
+
+        # reading the precomputed smoothed values produces the same peaks, 
+        # the strands may be interleaved differently as the chunks differ
+        smoothed = conf.tempdata('test-hdflib-smoothed.hdf')
+        hdflib.PositionalData(fname=inpfile, index=smoothed, update=True, sigmas=[5]).close()
+        options.workers, options.index = 1, True
+        peakpred.predict(smoothed, outfile, options)
+        self.assertEqual( sorted( file(outfile) ), sorted( serial.splitlines(True) ) )
+
+        # the stored peaks are queried by interval
+        from genetrack import peaklib
+        options.store = True
+        peakpred.predict(smoothed, outfile, options)
+        peaks = peaklib.PeakData( peaklib.peak_path(smoothed) )
+        self.assertEqual( peaks.attrs.strand, peakpred.TWOSTRAND )
+        self.assertEqual( peaks.attrs.method, 'gauss' )
+        lines = [ line.split() for line in file(outfile) ]
+        found = peaks.query( 'chr1', 0, 10**9 )
+        self.assertEqual( len(found.start), len( [ line for line in lines if line[0] == 'chr1' ] ) )
+        found = peaks.query( 'chr2', 1000, 2000, strand='-' )
+        expected = [ int(start) for chrom, start, end, dot, value, strand in lines 
+            if chrom == 'chr2' and strand == '-' and int(end) > 1000 and int(start) < 2000 ]
+        self.assertEqual( list(found.start), sorted(expected) )
+        peaks.close()
+
 def get_suite():
     "Returns the testsuite"
     tests  = [ 